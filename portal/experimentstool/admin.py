@@ -1,7 +1,10 @@
 from django.contrib import admin
-from .models import Application, AppInstance, WorkflowExecution, HPCInfrastructure
+from .models import Application, AppInstance, WorkflowExecution, \
+    ExecutionEvent, HPCInfrastructure, Sweep
 
 admin.site.register(Application)
 admin.site.register(AppInstance)
 admin.site.register(WorkflowExecution)
+admin.site.register(ExecutionEvent)
 admin.site.register(HPCInfrastructure)
+admin.site.register(Sweep)
@@ -0,0 +1,218 @@
+""" CKAN datasets index module
+
+The datasets of the data catalogue are indexed in the `Dataset` table,
+shared by every user, so they are listed and searched locally and referenced
+by a stable id. The index is only written by the `sync_datasets` command:
+the first synchronization reads the whole catalogue, the next ones only
+the packages changed since the newest one indexed, from the CKAN recently
+changed packages activity.
+
+The metadata of a dataset (its resources) is asked with `package_show` and
+cached for as long as its `metadata_modified` revision does not change.
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Max
+
+from portal import http_client
+from experimentstool.models import Dataset, _create_dataset_fts
+
+
+# Get an instance of a logger
+LOGGER = logging.getLogger(__name__)
+
+SYNC_PAGE_SIZE = 500
+ACTIVITY_PAGE_SIZE = 100
+METADATA_CACHE_PREFIX = 'dataset_metadata:'
+
+
+class CatalogueError(Exception):
+    pass
+
+
+def _call(action, **params):
+    url = settings.DATACATALOGUE_URL + "/api/3/action/" + action
+    json_data = http_client.get_json(url, params=params)
+    if not json_data["success"]:
+        raise CatalogueError(str(json_data.get("error")))
+    return json_data["result"]
+
+
+def _save(packages, full=False):
+    """ Creates or updates the datasets of the packages. If full, the
+    datasets not in packages are removed. Returns how many changed """
+    changed = 0
+    with transaction.atomic():
+        existing = Dataset.objects.all()
+        if not full:
+            existing = existing.filter(
+                ckan_id__in=[package["id"] for package in packages])
+        datasets = {dataset.ckan_id: dataset for dataset in existing}
+
+        new_datasets = []
+        for package in packages:
+            dataset = datasets.pop(package["id"], None)
+            if dataset is None:
+                new_datasets.append(Dataset(
+                    ckan_id=package["id"],
+                    name=package["name"],
+                    title=package.get("title"),
+                    metadata_modified=package.get("metadata_modified")))
+            elif dataset.metadata_modified != \
+                    package.get("metadata_modified"):
+                dataset.name = package["name"]
+                dataset.title = package.get("title")
+                dataset.metadata_modified = package.get("metadata_modified")
+                dataset.save()
+                changed += 1
+        Dataset.objects.bulk_create(new_datasets)
+        changed += len(new_datasets)
+
+        if full and datasets:
+            Dataset.objects.filter(
+                pk__in=[dataset.pk for dataset in datasets.values()]).delete()
+            changed += len(datasets)
+
+    return changed
+
+
+def _full_sync():
+    packages = []
+    start = 0
+    while True:
+        result = _call("package_search",
+                       q="*:*",
+                       rows=SYNC_PAGE_SIZE,
+                       start=start)
+        packages.extend(result["results"])
+        start += SYNC_PAGE_SIZE
+        if start >= result["count"] or not result["results"]:
+            break
+    return _save(packages, full=True)
+
+
+def _incremental_sync(since):
+    """ Applies the activity newer than since, newest first """
+    seen = set()
+    updated = []
+    deleted = []
+    offset = 0
+    while True:
+        activities = _call("recently_changed_packages_activity_list",
+                           offset=offset,
+                           limit=ACTIVITY_PAGE_SIZE)
+        for activity in activities:
+            if activity["timestamp"] < since:
+                activities = []
+                break
+            package = activity.get("data", {}).get("package")
+            if package is None or package["id"] in seen:
+                continue
+            seen.add(package["id"])
+            if activity["activity_type"] == "deleted package" or \
+                    package.get("private") or \
+                    package.get("state", "active") != "active":
+                deleted.append(package["id"])
+            else:
+                updated.append(package)
+        if len(activities) < ACTIVITY_PAGE_SIZE:
+            break
+        offset += ACTIVITY_PAGE_SIZE
+
+    changed = _save(updated)
+    if deleted:
+        changed += Dataset.objects.filter(ckan_id__in=deleted).delete()[0]
+    return changed
+
+
+def sync():
+    """ Updates the datasets index, returns the number of datasets changed
+    and a string error """
+    error = None
+    changed = 0
+    _create_dataset_fts()
+    since = Dataset.objects.aggregate(
+        since=Max('metadata_modified'))['since']
+    try:
+        if since is None:
+            changed = _full_sync()
+        else:
+            changed = _incremental_sync(since)
+    except (requests.exceptions.RequestException,
+            ValueError,
+            KeyError,
+            CatalogueError) as err:
+        LOGGER.exception(err)
+        error = "Couldn't sync the datasets: " + str(err)
+
+    return (changed, error)
+
+
+def _fetch_metadata(dataset):
+    try:
+        return (_call("package_show", id=dataset.ckan_id), None)
+    except (requests.exceptions.RequestException,
+            ValueError,
+            CatalogueError) as err:
+        LOGGER.exception(err)
+        return (None, "Couldn't get the dataset " + dataset.name + ": " +
+                str(err))
+
+
+def get_metadata(dataset_pks):
+    """ Returns a dict with the CKAN metadata of each indexed dataset by
+    pk, and a string error
+
+    Metadata is reused while the revision in the index does not change,
+    the rest is asked concurrently.
+    """
+    datasets = Dataset.objects.in_bulk(dataset_pks)
+    if len(datasets) < len(set(dataset_pks)):
+        return (None, 'Dataset does not exist')
+
+    keys = {pk: METADATA_CACHE_PREFIX + dataset.ckan_id
+            for pk, dataset in datasets.items()}
+    cached = cache.get_many(keys.values())
+    metadata = {}
+    missing = []
+    for pk, dataset in datasets.items():
+        entry = cached.get(keys[pk])
+        if entry is not None and dataset.metadata_modified is not None and \
+                entry['revision'] == dataset.metadata_modified:
+            metadata[pk] = entry['metadata']
+        else:
+            missing.append(pk)
+    if not missing:
+        return (metadata, None)
+
+    workers = min(settings.DATASETS_WORKERS, len(missing))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        responses = list(executor.map(
+            lambda pk: _fetch_metadata(datasets[pk]), missing))
+
+    error = None
+    to_cache = {}
+    for pk, (package, package_error) in zip(missing, responses):
+        if package_error is not None:
+            error = error or package_error
+            continue
+        metadata[pk] = package
+        revision = package.get("metadata_modified")
+        to_cache[keys[pk]] = {'revision': revision, 'metadata': package}
+        if revision != datasets[pk].metadata_modified:
+            # the index was behind, so catch up with this one
+            Dataset.objects.filter(pk=pk).update(name=package["name"],
+                                                 title=package.get("title"),
+                                                 metadata_modified=revision)
+    cache.set_many(to_cache, settings.DATASETS_METADATA_TIMEOUT)
+
+    if error is not None:
+        return (None, error)
+    return (metadata, None)
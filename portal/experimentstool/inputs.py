@@ -0,0 +1,121 @@
+""" Deployment inputs module
+
+Translates the inputs of the deployment form into TOSCA inputs. HPC inputs
+hold the id of one of the user infrastructures, and dataset inputs the id
+of an indexed dataset plus the index of one of its resources. A resolver
+loads the user infrastructures once and keeps the datasets metadata, so
+resolving many sets of inputs (i.e. a sweep) pays for them only once.
+"""
+
+import re
+import time
+
+from experimentstool import datasets
+from experimentstool.models import HPCInfrastructure
+
+
+HPC_PATTERN = re.compile('^mso4sc_hpc_(.)*$')
+DATASET_PATTERN = re.compile('^mso4sc_dataset_(.)*$')
+DATASET_RESOURCE_PATTERN = re.compile('^resource_mso4sc_dataset_(.)*$')
+
+HPC = 'hpc'
+DATASET = 'dataset'
+OTHER = 'other'
+
+
+class InputsResolver(object):
+    """ Resolves the deployment inputs of a user
+
+    `timings` accumulates the seconds spent on each kind of input.
+    """
+
+    def __init__(self, owner):
+        self.owner = owner
+        self.timings = {HPC: 0.0, DATASET: 0.0, OTHER: 0.0}
+        self._hpcs = None
+        self._datasets = {}
+
+    def _get_hpcs(self):
+        if self._hpcs is None:
+            hpc_list, error = HPCInfrastructure.list(self.owner)
+            if error is not None:
+                return (None, error)
+            self._hpcs = {hpc.id: hpc for hpc in hpc_list}
+        return (self._hpcs, None)
+
+    def _load_datasets(self, inputs):
+        """ Gets the metadata of all the datasets not known yet at once """
+        dataset_pks = set(value for _input, value in inputs.items()
+                          if DATASET_PATTERN.match(_input) and value >= 0)
+        missing = list(dataset_pks - set(self._datasets.keys()))
+        if missing:
+            metadata, error = datasets.get_metadata(missing)
+            if error is not None:
+                return error
+            self._datasets.update(metadata)
+        return None
+
+    def resolve(self, inputs):
+        """ Returns the TOSCA inputs, and a dict with the error """
+        start = time.monotonic()
+        hpcs, error = self._get_hpcs()
+        self.timings[HPC] += time.monotonic() - start
+        if error is not None:
+            return (None, {'error': error})
+
+        start = time.monotonic()
+        error = self._load_datasets(inputs)
+        self.timings[DATASET] += time.monotonic() - start
+        if error is not None:
+            return (None, {'error': error})
+
+        tosca_inputs = {}
+        for _input, value in inputs.items():
+            start = time.monotonic()
+            if HPC_PATTERN.match(_input):
+                kind = HPC
+                tosca_input, error = self._resolve_hpc(hpcs, value)
+            elif DATASET_PATTERN.match(_input):
+                kind = DATASET
+                tosca_input, error = self._resolve_dataset(
+                    value,
+                    inputs.get("resource_" + _input))
+            elif DATASET_RESOURCE_PATTERN.match(_input):
+                # Resources are managed with their dataset
+                continue
+            else:
+                kind = OTHER
+                tosca_input, error = (value, None)
+            self.timings[kind] += time.monotonic() - start
+
+            if error is not None:
+                return (None, {'error': error})
+            tosca_inputs[_input] = tosca_input
+
+        return (tosca_inputs, None)
+
+    @staticmethod
+    def _resolve_hpc(hpcs, hpc_pk):
+        if hpc_pk < 0:
+            # the hpc input has no configuration
+            return ({}, None)
+
+        hpc = hpcs.get(hpc_pk)
+        if hpc is None:
+            return (None, 'Bad HPC provided. Please refresh and try again')
+
+        return (hpc.to_dict(), None)
+
+    def _resolve_dataset(self, dataset_pk, resource_index):
+        if dataset_pk < 0 or resource_index is None:
+            # the dataset input has no configuration
+            return ("", None)
+
+        dataset = self._datasets[dataset_pk]
+        resource_index = int(resource_index)
+        if resource_index >= dataset["num_resources"] or resource_index < 0:
+            return (None, 'Bad dataset resource provided. Please ' +
+                    'refresh and try again')
+
+        # the url of the resource
+        return (dataset["resources"][resource_index]["url"], None)
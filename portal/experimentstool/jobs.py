@@ -0,0 +1,206 @@
+""" Background jobs module
+
+Long orchestrator operations are stored as `Job` rows by the views, and run
+here by a pool of worker threads (see the `process_jobs` command). Each job
+kind has a handler that returns a (result, error) tuple like the models do,
+or raises `RetryJob` when the operation must be tried again later.
+"""
+
+import json
+import time
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+
+from cloudify_rest_client.exceptions \
+    import DeploymentEnvironmentCreationPendingError
+from cloudify_rest_client.exceptions \
+    import DeploymentEnvironmentCreationInProgressError
+
+from experimentstool import packages
+from experimentstool.models import (Application,
+                                    AppInstance,
+                                    Job,
+                                    Sweep,
+                                    _to_dict)
+
+
+# Get an instance of a logger
+LOGGER = logging.getLogger(__name__)
+
+HANDLERS = {}
+
+
+class RetryJob(Exception):
+    """ The job could not be done yet, but may succeed later """
+    pass
+
+
+def handler(kind):
+    def register(function):
+        HANDLERS[kind] = function
+        return function
+    return register
+
+
+def backoff_delay(attempts):
+    """ Seconds to wait before the next attempt, doubling on each one """
+    return min(settings.JOBS_RETRY_DELAY * 2 ** (attempts - 1),
+               settings.JOBS_RETRY_MAX_DELAY)
+
+
+def run_job(job):
+    job_handler = HANDLERS.get(job.kind)
+    if job_handler is None:
+        job.fail('Unknown job kind ' + job.kind)
+        return
+
+    result = None
+    try:
+        result, error = job_handler(job, json.loads(job.payload))
+    except RetryJob as err:
+        if job.attempts < settings.JOBS_MAX_ATTEMPTS:
+            job.retry(str(err), backoff_delay(job.attempts))
+            return
+        error = str(err)
+    except Exception as err:
+        LOGGER.exception(err)
+        error = str(err)
+
+    if error is not None:
+        job.fail(error)
+    else:
+        job.finish(result)
+
+
+def _work(poll_interval):
+    while True:
+        try:
+            job = Job.claim()
+            if job is None:
+                time.sleep(poll_interval)
+            else:
+                run_job(job)
+        except Exception as err:
+            # keep the worker alive, i.e. database locked
+            LOGGER.exception(err)
+            time.sleep(poll_interval)
+        finally:
+            close_old_connections()
+
+
+def work(workers, poll_interval):
+    """ Runs the jobs with a pool of worker threads, forever """
+    _clean_packages()
+    requeued = Job.requeue_running()
+    if requeued > 0:
+        LOGGER.warning(str(requeued) + ' interrupted jobs requeued')
+
+    threads = [threading.Thread(target=_work,
+                                args=(poll_interval,),
+                                name='jobs-' + str(index),
+                                daemon=True)
+               for index in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+@handler(Job.CREATE_DEPLOYMENT)
+def _create_deployment(job, payload):
+    try:
+        instance, error = AppInstance.create(payload['app_pk'],
+                                             payload['deployment_id'],
+                                             payload['inputs'],
+                                             job.owner)
+    except (DeploymentEnvironmentCreationPendingError,
+            DeploymentEnvironmentCreationInProgressError) as err:
+        raise RetryJob(str(err))
+
+    return ({'instance': _to_dict(instance)}, error)
+
+
+@handler(Job.CREATE_SWEEP)
+def _create_sweep(job, payload):
+    sweep, error = Sweep.get(payload['sweep_pk'], job.owner)
+    if error is None and sweep is None:
+        error = "Can't create sweep deployments because it doesn't exists"
+    if error is not None:
+        return (None, error)
+
+    deployments = payload['deployments']
+    lock = threading.Lock()
+    done = [0]
+
+    def create(deployment):
+        try:
+            instance, error = _create_sweep_deployment(sweep, deployment)
+            with lock:
+                done[0] += 1
+                job.set_progress(int(done[0] * 100 / len(deployments)))
+        finally:
+            # each thread of the executor opens its own connection
+            connection.close()
+        return {'deployment_id': deployment['deployment_id'],
+                'instance': _to_dict(instance),
+                'error': error}
+
+    workers = min(settings.SWEEP_PARALLELISM, len(deployments))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(create, deployments))
+
+    error = None
+    if not any(result['instance'] is not None for result in results):
+        error = 'No sweep deployment could be created'
+    return ({'sweep': _to_dict(sweep), 'results': results}, error)
+
+
+def _create_sweep_deployment(sweep, deployment):
+    """ Creates one of the deployments, waiting while the orchestrator is
+    busy creating the environment of other deployments """
+    attempts = 0
+    while True:
+        attempts += 1
+        try:
+            return AppInstance.create(sweep.app_id,
+                                      deployment['deployment_id'],
+                                      deployment['inputs'],
+                                      sweep.owner,
+                                      sweep=sweep)
+        except (DeploymentEnvironmentCreationPendingError,
+                DeploymentEnvironmentCreationInProgressError) as err:
+            if attempts >= settings.JOBS_MAX_ATTEMPTS:
+                return (None, str(err))
+            time.sleep(backoff_delay(attempts))
+
+
+@handler(Job.UPLOAD_BLUEPRINT)
+def _upload_blueprint(job, payload):
+    def progress_callback(sent, total):
+        if total > 0:
+            job.set_progress(int(sent * 100 / total))
+
+    try:
+        app, error = Application.create(packages.path(payload['digest']),
+                                        payload['blueprint_id'],
+                                        payload['marketplace_id'],
+                                        job.owner,
+                                        digest=payload['digest'],
+                                        progress_callback=progress_callback)
+    finally:
+        _clean_packages()
+
+    return ({'app': _to_dict(app)}, error)
+
+
+def _clean_packages():
+    used = set(Application.objects.exclude(digest=None)
+               .values_list('digest', flat=True))
+    # packages of the uploads still to be run are in use as well
+    used.update(Job.get_upload_digests())
+    packages.clean(settings.BLUEPRINT_STORE_MAX_AGE, used)
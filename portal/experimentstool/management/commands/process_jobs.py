@@ -0,0 +1,25 @@
+""" Runs the background jobs of the experiments tool """
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from experimentstool import jobs
+
+
+class Command(BaseCommand):
+    help = 'Processes the pending orchestrator jobs with a pool of workers'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=settings.JOBS_WORKERS,
+            help='Number of jobs processed at the same time')
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=settings.JOBS_POLL_INTERVAL,
+            help='Seconds between checks for new jobs')
+
+    def handle(self, *args, **options):
+        jobs.work(options['workers'], options['interval'])
@@ -0,0 +1,46 @@
+""" Keeps the local datasets index up to date """
+
+import time
+import logging
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from experimentstool import datasets
+
+
+# Get an instance of a logger
+LOGGER = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Synchronizes the datasets index with the data catalogue'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval',
+            type=int,
+            default=settings.DATASETS_SYNC_INTERVAL,
+            help='Seconds between two synchronizations')
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Synchronize once and exit')
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                changed, error = datasets.sync()
+                if error is not None:
+                    LOGGER.error(error)
+                elif changed > 0:
+                    LOGGER.info(str(changed) + ' datasets updated')
+            except Exception as err:
+                # keep the loop alive, i.e. database locked
+                LOGGER.exception(err)
+                connection.close()
+
+            if options['once']:
+                break
+            time.sleep(options['interval'])
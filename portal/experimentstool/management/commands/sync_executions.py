@@ -0,0 +1,47 @@
+""" Keeps the status of the workflow executions up to date """
+
+import time
+import logging
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from experimentstool.models import WorkflowExecution
+
+
+# Get an instance of a logger
+LOGGER = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Synchronizes the status of the running workflow executions ' + \
+        'with the orchestrator'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval',
+            type=int,
+            default=settings.EXECUTIONS_SYNC_INTERVAL,
+            help='Seconds between two synchronizations')
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Synchronize once and exit')
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                updated, error = WorkflowExecution.sync_statuses()
+                if error is not None:
+                    LOGGER.error("Couldn't sync executions: " + error)
+                elif updated > 0:
+                    LOGGER.info(str(updated) + ' executions updated')
+            except Exception as err:
+                # keep the loop alive, i.e. database locked
+                LOGGER.exception(err)
+                connection.close()
+
+            if options['once']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,70 @@
+""" Keeps the local Marketplace mirror up to date """
+
+import time
+import logging
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from social_django.models import UserSocialAuth
+from social_django.utils import load_strategy
+
+from experimentstool import marketplace
+
+
+# Get an instance of a logger
+LOGGER = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Synchronizes the stock and inventory of the portal users ' + \
+        'with the Marketplace'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval',
+            type=int,
+            default=settings.MARKETPLACE_SYNC_INTERVAL,
+            help='Seconds between two synchronizations')
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Synchronize once and exit')
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                self._sync_all()
+            except Exception as err:
+                # keep the loop alive, i.e. database locked
+                LOGGER.exception(err)
+                connection.close()
+
+            if options['once']:
+                break
+            time.sleep(options['interval'])
+
+    def _sync_all(self):
+        strategy = load_strategy()
+        for social in UserSocialAuth.objects.filter(provider='fiware'):
+            uid = social.extra_data.get('uid')
+            try:
+                # refreshed if expired
+                access_token = social.get_access_token(strategy)
+            except Exception as err:
+                LOGGER.warning("Couldn't get the token of " + str(uid) +
+                               ': ' + str(err))
+                continue
+
+            try:
+                # skipped if a view is already synchronizing the party
+                error = marketplace.sync_locked(access_token, uid)
+            except Exception as err:
+                # the other parties are still synchronized
+                LOGGER.exception(err)
+                connection.close()
+                continue
+            if error is not None:
+                LOGGER.error("Couldn't sync the Marketplace of " + uid +
+                             ': ' + error)
@@ -0,0 +1,298 @@
+""" Marketplace module
+
+The launched products (stock) and the bought products (inventory) of each
+party are mirrored in local tables, so the views join them with the
+applications in the database instead of asking the Marketplace. The
+mirror of a party is refreshed by the `sync_marketplace` command, and in
+background when a view finds it older than MARKETPLACE_CACHE_TTL seconds.
+A party never seen before is synchronized before answering. Only one
+synchronization of a party runs at a time, among every process.
+"""
+
+import json
+import time
+import logging
+import threading
+from datetime import timedelta
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction, IntegrityError
+from django.utils import timezone
+
+from portal import http_client
+from experimentstool.models import (ProductSpecification,
+                                    ProductOffering,
+                                    InventoryProduct,
+                                    MarketplaceSync)
+
+
+# Get an instance of a logger
+LOGGER = logging.getLogger(__name__)
+
+# seconds between two attempts to take the lock of a synchronization
+LOCK_POLL = 0.2
+
+
+def _fetch_stock(access_token, uid):
+    headers = {"Authorization": "bearer " + access_token}
+    url = settings.MARKETPLACE_URL + \
+        "/DSProductCatalog/api/catalogManagement/v2/productSpecification" + \
+        "?lifecycleStatus=Launched" + \
+        "&relatedParty.id=" + uid
+
+    try:
+        return http_client.get_json(url, headers=headers)
+    except (requests.exceptions.RequestException, ValueError) as err:
+        return {'error': "Couldn't get the stock from the Marketplace: " +
+                str(err)}
+
+
+def _fetch_inventory(access_token, uid):
+    headers = {"Authorization": "bearer " + access_token}
+    url = settings.MARKETPLACE_URL + \
+        "/DSProductInventory/api/productInventory/v2/product" + \
+        "?status=Active" + \
+        "&relatedParty.id=" + uid
+
+    try:
+        return http_client.get_json(url, headers=headers)
+    except (requests.exceptions.RequestException, ValueError) as err:
+        return {'error': "Couldn't get the inventory from the Marketplace: " +
+                str(err)}
+
+
+def _fetch_offering_productid(path, access_token):
+    headers = {"Authorization": "bearer " + access_token}
+    url = settings.MARKETPLACE_URL + path
+
+    json_data = http_client.get_json(url, headers=headers)
+
+    try:
+        return json_data["productSpecification"]["id"]
+    except (KeyError, TypeError):
+        raise ValueError('Offering ' + path + ' has no product specification')
+
+
+def _get_offering_path(product):
+    return urlparse(product["productOffering"]['href']).path
+
+
+def _sync_offerings(paths, access_token, now):
+    """ Resolves the product of the offerings not known, or known for more
+    than OFFERING_CACHE_TIMEOUT seconds, concurrently """
+    known = ProductOffering.objects.filter(
+        path__in=paths,
+        synced_on__gte=now - timedelta(
+            seconds=settings.OFFERING_CACHE_TIMEOUT)) \
+        .values_list('path', flat=True)
+    missing = list(set(paths) - set(known))
+    if not missing:
+        return
+
+    workers = min(settings.MARKETPLACE_WORKERS, len(missing))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        productids = list(executor.map(
+            lambda path: _fetch_offering_productid(path, access_token),
+            missing))
+
+    with transaction.atomic():
+        for path, productid in zip(missing, productids):
+            ProductOffering.objects.update_or_create(
+                path=path,
+                defaults={'marketplace_id': productid, 'synced_on': now})
+
+
+def sync(access_token, uid):
+    """ Refreshes the Marketplace mirror of a party, returns a string error
+
+    Both lists are always asked whole, as the Marketplace has no reliable
+    way to ask for the changes only, but a product is only written when
+    its lastUpdate changed, and offerings are only asked when not known.
+    """
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        stock_future = executor.submit(_fetch_stock, access_token, uid)
+        inventory_future = executor.submit(_fetch_inventory,
+                                           access_token,
+                                           uid)
+        stock_data = stock_future.result()
+        inventory_data = inventory_future.result()
+    if 'error' in stock_data:
+        return stock_data['error']
+    if 'error' in inventory_data:
+        return inventory_data['error']
+
+    error = None
+    for _ in range(2):
+        now = timezone.now()
+        try:
+            _sync_offerings([_get_offering_path(product)
+                             for product in inventory_data],
+                            access_token,
+                            now)
+            _store(uid, stock_data, inventory_data, now)
+            return None
+        except (requests.exceptions.RequestException,
+                ValueError,
+                KeyError,
+                TypeError) as err:
+            # i.e. an inventory product without offering
+            return "Couldn't get the offerings from the Marketplace: " + \
+                str(err)
+        except IntegrityError as err:
+            # a synchronization not holding the lock inserted the same
+            # rows meanwhile, they are read again
+            LOGGER.warning("Conflict syncing the Marketplace of " + uid +
+                           ': ' + str(err))
+            error = "Couldn't store the Marketplace mirror: " + str(err)
+
+    return error
+
+
+def _store(uid, stock_data, inventory_data, now):
+    """ Writes the changes of the lists to the mirror of the party """
+    with transaction.atomic():
+        specifications = {
+            specification.marketplace_id: specification
+            for specification in ProductSpecification.objects.filter(
+                related_party=uid)}
+        new_specifications = []
+        for product in stock_data:
+            specification = specifications.pop(product["id"], None)
+            last_update = product.get('lastUpdate')
+            if specification is None:
+                new_specifications.append(ProductSpecification(
+                    marketplace_id=product["id"],
+                    related_party=uid,
+                    data=json.dumps(product),
+                    last_update=last_update,
+                    synced_on=now))
+            elif last_update is None or \
+                    specification.last_update != last_update:
+                specification.data = json.dumps(product)
+                specification.last_update = last_update
+                specification.synced_on = now
+                specification.save()
+        ProductSpecification.objects.bulk_create(new_specifications)
+        ProductSpecification.objects.filter(
+            pk__in=[specification.pk
+                    for specification in specifications.values()]).delete()
+
+        inventory = {
+            product.inventory_id: product
+            for product in InventoryProduct.objects.filter(
+                related_party=uid)}
+        new_inventory = []
+        for product in inventory_data:
+            inventory_product = inventory.pop(str(product["id"]), None)
+            path = _get_offering_path(product)
+            if inventory_product is None:
+                new_inventory.append(InventoryProduct(
+                    inventory_id=str(product["id"]),
+                    related_party=uid,
+                    offering_path=path,
+                    synced_on=now))
+            elif inventory_product.offering_path != path:
+                inventory_product.offering_path = path
+                inventory_product.synced_on = now
+                inventory_product.save()
+        InventoryProduct.objects.bulk_create(new_inventory)
+        InventoryProduct.objects.filter(
+            pk__in=[product.pk for product in inventory.values()]).delete()
+
+        MarketplaceSync.objects.update_or_create(
+            related_party=uid,
+            defaults={'synced_on': now})
+
+
+def _get_lock_key(uid):
+    return 'marketplace_sync:' + uid
+
+
+def _get_lock_timeout():
+    # both lists, and then the offerings, are fetched
+    return 2 * settings.HTTP_DEADLINE + 10
+
+
+def _acquire(uid, wait=0):
+    """ Takes the lock of the synchronization of the party, waiting up to
+    wait seconds for the one running. Returns whether it was taken """
+    deadline = time.monotonic() + wait
+    while not cache.add(_get_lock_key(uid), True, _get_lock_timeout()):
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(LOCK_POLL)
+    return True
+
+
+def _release(uid):
+    cache.delete(_get_lock_key(uid))
+
+
+def sync_locked(access_token, uid):
+    """ Refreshes the mirror of the party unless it is already being
+    refreshed, returns a string error """
+    if not _acquire(uid):
+        return None
+    try:
+        return sync(access_token, uid)
+    finally:
+        _release(uid)
+
+
+def _sync_in_background(access_token, uid):
+    # only one synchronization of the same party at a time
+    if not _acquire(uid):
+        return
+
+    def background_sync():
+        try:
+            error = sync(access_token, uid)
+            if error is not None:
+                LOGGER.error("Couldn't sync the Marketplace of " + uid +
+                             ': ' + error)
+        except Exception as err:
+            LOGGER.exception(err)
+        finally:
+            _release(uid)
+            connection.close()
+
+    threading.Thread(target=background_sync,
+                     name='marketplace-' + uid,
+                     daemon=True).start()
+
+
+def _first_sync(access_token, uid):
+    """ Synchronizes a party never seen before. The requests arriving
+    meanwhile wait for it instead of starting their own """
+    if not _acquire(uid, wait=_get_lock_timeout()):
+        return 'The Marketplace is still being synchronized, ' + \
+            'try again later'
+    try:
+        if MarketplaceSync.objects.filter(related_party=uid).exists():
+            return None
+        return sync(access_token, uid)
+    finally:
+        _release(uid)
+
+
+def ensure_synced(access_token, uid):
+    """ Makes sure the mirror of the party can be used, returns a string
+    error. Only waits for the Marketplace if it was never synchronized """
+    state = MarketplaceSync.objects.filter(related_party=uid).first()
+    if state is None:
+        return _first_sync(access_token, uid)
+
+    if state.synced_on is None or timezone.now() - state.synced_on > \
+            timedelta(seconds=settings.MARKETPLACE_CACHE_TTL):
+        _sync_in_background(access_token, uid)
+    return None
+
+
+def invalidate(uid):
+    """ Marks the mirror of the party to be refreshed on its next use """
+    MarketplaceSync.objects.filter(related_party=uid).update(synced_on=None)
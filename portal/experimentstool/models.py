@@ -1,15 +1,26 @@
+import re
 import json
-import time
 import logging
+import itertools
 from urllib.parse import urlparse
-from datetime import datetime
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 
-from django.conf import settings
-from django.db import models
+import requests
 
+from django.conf import settings
+from django.db import (models,
+                       connection,
+                       transaction,
+                       DatabaseError,
+                       IntegrityError)
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from django.core.serializers.json import DjangoJSONEncoder
 from django.forms.models import model_to_dict
 
-from cloudify_rest_client import CloudifyClient
 from cloudify_rest_client.executions import Execution
 from cloudify_rest_client.exceptions import CloudifyClientError
 from cloudify_rest_client.exceptions \
@@ -17,7 +28,13 @@ from cloudify_rest_client.exceptions \
 from cloudify_rest_client.exceptions \
     import DeploymentEnvironmentCreationInProgressError
 
-WAIT_FOR_EXECUTION_SLEEP_INTERVAL = 3
+from experimentstool import orchestrator
+from experimentstool import packages
+from experimentstool import streams
+
+EVENTS_PAGE_SIZE = 100
+# executions asked to the orchestrator on each status list request
+STATUS_SYNC_BATCH_SIZE = 100
 
 # Get an instance of a logger
 LOGGER = logging.getLogger(__name__)
@@ -30,6 +47,16 @@ def _to_dict(model_instance):
         return model_to_dict(model_instance)
 
 
+def _parse_timestamp(timestamp):
+    """ Orchestrator timestamps are UTC, with or without zone info """
+    if not timestamp:
+        return None
+    date = parse_datetime(timestamp.replace(' ', 'T'))
+    if date is not None and timezone.is_naive(date):
+        date = timezone.make_aware(date, timezone.utc)
+    return date
+
+
 class Orchestrator(models.Model):
     """ Custom permissions for Experiments Tool app """
 
@@ -185,11 +212,7 @@ class HPCInfrastructure(models.Model):
 
 
 def _get_client():
-    client = CloudifyClient(host=settings.ORCHESTRATOR_HOST,
-                            username=settings.ORCHESTRATOR_USER,
-                            password=settings.ORCHESTRATOR_PASS,
-                            tenant=settings.ORCHESTRATOR_TENANT)
-    return client
+    return orchestrator.get_client()
 
 
 class Application(models.Model):
@@ -197,6 +220,10 @@ class Application(models.Model):
 
     description = models.CharField(max_length=256, null=True)
     marketplace_id = models.CharField(max_length=10, db_index=True)
+    # sha256 of the blueprint package, see packages module
+    digest = models.CharField(max_length=64, null=True, db_index=True)
+    # JSON list of the blueprint inputs, parsed when the app is created
+    inputs = models.TextField(null=True)
 
     owner = models.ForeignKey(
         settings.AUTH_USER_MODEL,
@@ -244,17 +271,60 @@ class Application(models.Model):
             return {'app_list': [_to_dict(app) for app in app_list],
                     'error': error}
 
+    @classmethod
+    def list_by_party(cls, related_party, inventory=False, return_dict=False):
+        """ Applications of the products the party sells, and also of the
+        ones it bought if inventory, from the Marketplace mirror """
+        query = Q(marketplace_id__in=ProductSpecification.objects.filter(
+            related_party=related_party).values('marketplace_id'))
+        if inventory:
+            query |= Q(marketplace_id__in=ProductOffering.objects.filter(
+                path__in=InventoryProduct.objects.filter(
+                    related_party=related_party).values('offering_path'))
+                .values('marketplace_id'))
+
+        error = None
+        app_list = cls.objects.filter(query)
+
+        if not return_dict:
+            return (app_list, error)
+        else:
+            return {'app_list': [_to_dict(app) for app in app_list],
+                    'error': error}
+
     @classmethod
     def create(cls,
                path,
                blueprint_id,
                marketplace_id,
                owner,
+               digest=None,
+               progress_callback=None,
                return_dict=False):
+        """ If an application with the same package digest already exists,
+        its blueprint is reused instead of uploading the package again """
         error = None
         app = None
 
-        blueprint, error = cls._upload_blueprint(path, blueprint_id)
+        published = None
+        if digest is not None:
+            published = cls.objects.filter(digest=digest).first()
+
+        if published is not None:
+            LOGGER.info('Package ' + digest + ' already published as ' +
+                        published.name)
+            blueprint = {'id': published.name,
+                         'description': published.description}
+            inputs = published.inputs
+            if progress_callback is not None:
+                progress_callback(1, 1)
+        else:
+            blueprint, error = cls._upload_blueprint(path,
+                                                     blueprint_id,
+                                                     progress_callback)
+            if not error:
+                inputs = json.dumps(
+                    cls._parse_inputs(blueprint['plan']['inputs']))
 
         if not error:
             try:
@@ -262,11 +332,14 @@ class Application(models.Model):
                     name=blueprint['id'],
                     description=blueprint['description'],
                     marketplace_id=marketplace_id,
+                    digest=digest,
+                    inputs=inputs,
                     owner=owner)
             except Exception as err:
                 LOGGER.exception(err)
                 error = str(err)
-                cls._remove_blueprint(blueprint['id'])
+                if published is None:
+                    cls._remove_blueprint(blueprint['id'])
 
         if not return_dict:
             return (app, error)
@@ -280,7 +353,15 @@ class Application(models.Model):
         app = cls._get(pk)
 
         if app is not None:
-            inputs, error = cls._get_inputs(app.name)
+            if app.inputs is not None:
+                inputs = json.loads(app.inputs)
+                error = None
+            else:
+                # created before inputs were stored, ask once and keep them
+                inputs, error = cls._get_inputs(app.name)
+                if error is None:
+                    cls.objects.filter(name=app.name, inputs=None) \
+                        .update(inputs=json.dumps(inputs))
         else:
             error = "Can't get app inputs because it doesn't exists"
 
@@ -295,9 +376,19 @@ class Application(models.Model):
 
         if error is None:
             if app is not None:
-                _, error = cls._remove_blueprint(app.name)
+                # the blueprint may be shared with other applications
+                shared = cls.objects.filter(name=app.name) \
+                    .exclude(pk=app.pk).exists()
+                if not shared:
+                    _, error = cls._remove_blueprint(app.name)
                 if error is None:
                     app.delete()
+                    # unless another upload of the package is on its way
+                    if app.digest is not None and \
+                            not cls.objects.filter(
+                                digest=app.digest).exists() and \
+                            app.digest not in Job.get_upload_digests():
+                        packages.remove(app.digest)
             else:
                 error = "Can't delete aplication because it doesn't exists"
 
@@ -312,7 +403,9 @@ class Application(models.Model):
             self.owner.username)
 
     @staticmethod
-    def _upload_blueprint(path, blueprint_id):
+    def _upload_blueprint(path, blueprint_id, progress_callback=None):
+        """ progress_callback(bytes_sent, total_bytes) is called as the
+        package is streamed to the orchestrator """
         error = None
         blueprint = None
         is_archive = bool(urlparse(path).scheme) or path.endswith(".tar.gz")
@@ -321,9 +414,10 @@ class Application(models.Model):
         try:
             if is_archive:
                 blueprint = client.blueprints.publish_archive(
-                    path, blueprint_id)
+                    path, blueprint_id, progress_callback=progress_callback)
             else:
-                blueprint = client.blueprints.upload(path, blueprint_id)
+                blueprint = client.blueprints.upload(
+                    path, blueprint_id, progress_callback=progress_callback)
         except CloudifyClientError as err:
             LOGGER.exception(err)
             error = str(err)
@@ -350,18 +444,22 @@ class Application(models.Model):
         client = _get_client()
         try:
             blueprint_dict = client.blueprints.get(app_id)
-            inputs = blueprint_dict['plan']['inputs']
-            data = [{'name': name,
-                     'type': input.get('type', '-'),
-                     'default': input.get('default', '-'),
-                     'description': input.get('description', '-')}
-                    for name, input in inputs.items()]
+            data = Application._parse_inputs(blueprint_dict['plan']['inputs'])
         except CloudifyClientError as err:
             LOGGER.exception(err)
             error = str(err)
 
         return (data, error)
 
+    @staticmethod
+    def _parse_inputs(inputs):
+        """ Returns a list of dict from the inputs of a blueprint plan """
+        return [{'name': name,
+                 'type': input.get('type', '-'),
+                 'default': input.get('default', '-'),
+                 'description': input.get('description', '-')}
+                for name, input in inputs.items()]
+
     @staticmethod
     def _remove_blueprint(app_id):
         error = None
@@ -376,6 +474,184 @@ class Application(models.Model):
         return (blueprint, error)
 
 
+class ProductSpecification(models.Model):
+    """ Launched Marketplace product of a party, mirrored locally """
+    marketplace_id = models.CharField(max_length=10, db_index=True)
+    related_party = models.CharField(max_length=50, db_index=True)
+    # json encoded product as the Marketplace returns it
+    data = models.TextField()
+    last_update = models.CharField(max_length=50, null=True)
+    synced_on = models.DateTimeField(editable=True)
+
+    class Meta:
+        unique_together = (('related_party', 'marketplace_id'),)
+
+    @classmethod
+    def list_new(cls, related_party, return_dict=False):
+        """ Products of the party with no application registered yet """
+        error = None
+        product_list = cls.objects.filter(related_party=related_party) \
+            .exclude(marketplace_id__in=Application.objects.values(
+                'marketplace_id'))
+
+        if not return_dict:
+            return (product_list, error)
+        else:
+            return {'product_list': [json.loads(product.data)
+                                     for product in product_list],
+                    'error': error}
+
+    def __str__(self):
+        return "Product {0} of {1}".format(
+            self.marketplace_id,
+            self.related_party)
+
+
+class ProductOffering(models.Model):
+    """ Marketplace offering, and the product it offers """
+    path = models.CharField(max_length=256, unique=True)
+    marketplace_id = models.CharField(max_length=10, db_index=True)
+    synced_on = models.DateTimeField(editable=True)
+
+    def __str__(self):
+        return "Offering {0} of product {1}".format(
+            self.path,
+            self.marketplace_id)
+
+
+class InventoryProduct(models.Model):
+    """ Active product bought by a party, mirrored locally """
+    inventory_id = models.CharField(max_length=50)
+    related_party = models.CharField(max_length=50, db_index=True)
+    offering_path = models.CharField(max_length=256, db_index=True)
+    synced_on = models.DateTimeField(editable=True)
+
+    class Meta:
+        unique_together = (('related_party', 'inventory_id'),)
+
+    def __str__(self):
+        return "Inventory product {0} of {1}".format(
+            self.inventory_id,
+            self.related_party)
+
+
+class MarketplaceSync(models.Model):
+    """ Last synchronization of the Marketplace mirror of a party """
+    related_party = models.CharField(max_length=50, unique=True)
+    # None when it has to be refreshed
+    synced_on = models.DateTimeField(null=True, editable=True)
+
+
+class Sweep(models.Model):
+    """ Group of instances of an application created together, each one
+    from the same base inputs with some of them overridden """
+    name = models.CharField(max_length=50)
+    app = models.ForeignKey(
+        Application,
+        on_delete=models.CASCADE,
+    )
+    size = models.PositiveIntegerField(default=0)
+    # can't use auto_now_add because it set editable=False
+    # and therefore model_to_dict skips the field
+    created_on = models.DateTimeField(editable=True)
+
+    owner = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+    )
+
+    @classmethod
+    def get(cls, pk, owner, return_dict=False):
+        error = None
+        sweep = None
+        try:
+            sweep = cls.objects.get(pk=pk)
+        except cls.DoesNotExist:
+            pass
+
+        if sweep is not None and owner != sweep.owner:
+            sweep = None
+            error = 'Sweep does not belong to user'
+
+        if not return_dict:
+            return (sweep, error)
+        else:
+            instance_list = []
+            if sweep is not None:
+                instance_list = [_to_dict(instance)
+                                 for instance in sweep.appinstance_set.all()]
+                sweep = _to_dict(sweep)
+            return {'sweep': sweep,
+                    'instance_list': instance_list,
+                    'error': error}
+
+    @classmethod
+    def list(cls, owner, return_dict=False):
+        error = None
+        sweep_list = []
+        try:
+            sweep_list = cls.objects.filter(owner=owner)
+        except cls.DoesNotExist:
+            pass
+
+        if not return_dict:
+            return (sweep_list, error)
+        else:
+            return {'sweep_list': [_to_dict(sweep) for sweep in sweep_list],
+                    'error': error}
+
+    @classmethod
+    def create(cls, app_pk, name, size, owner, return_dict=False):
+        error = None
+        sweep = None
+
+        app, error = Application.get(app_pk)
+        if error is None:
+            if app is None:
+                error = "Can't create sweep because app doesn't exists"
+            else:
+                try:
+                    sweep = cls.objects.create(name=name,
+                                               app=app,
+                                               size=size,
+                                               created_on=timezone.now(),
+                                               owner=owner)
+                except Exception as err:
+                    LOGGER.exception(err)
+                    error = str(err)
+
+        if not return_dict:
+            return (sweep, error)
+        else:
+            return {'sweep': _to_dict(sweep), 'error': error}
+
+    @staticmethod
+    def expand(grid=None, overrides=None):
+        """ Returns the list of inputs overrides of every deployment
+
+        grid is a dict with a list of values for each input, and every
+        combination of them is used. overrides is a list of dict that are
+        combined with each of the grid combinations.
+        """
+        combinations = [{}]
+        if grid:
+            names = sorted(grid.keys())
+            combinations = [dict(zip(names, values))
+                            for values in itertools.product(
+                                *[grid[name] for name in names])]
+        if overrides:
+            combinations = [dict(combination, **override)
+                            for combination in combinations
+                            for override in overrides]
+        return combinations
+
+    def __str__(self):
+        return "Sweep {0} of {1} from {2}".format(
+            self.name,
+            self.app.name,
+            self.owner.username)
+
+
 class AppInstance(models.Model):
     name = models.CharField(max_length=50)
     app = models.ForeignKey(
@@ -386,6 +662,12 @@ class AppInstance(models.Model):
     description = models.CharField(max_length=256, null=True)
     inputs = models.CharField(max_length=256, null=True)
     outputs = models.CharField(max_length=256, null=True)
+    sweep = models.ForeignKey(
+        Sweep,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+    )
 
     owner = models.ForeignKey(
         settings.AUTH_USER_MODEL,
@@ -429,7 +711,8 @@ class AppInstance(models.Model):
                 'error': error}
 
     @classmethod
-    def create(cls, app_pk, deployment_id, inputs, owner, return_dict=False):
+    def create(cls, app_pk, deployment_id, inputs, owner,
+               sweep=None, return_dict=False):
         error = None
         instance = None
 
@@ -456,6 +739,7 @@ class AppInstance(models.Model):
                         deployment['outputs'],
                         ensure_ascii=False,
                         separators=(',', ':')),
+                    sweep=sweep,
                     owner=owner)
             except Exception as err:
                 LOGGER.exception(err)
@@ -492,8 +776,9 @@ class AppInstance(models.Model):
             self.name,
             self.owner.username)
 
-    @classmethod
-    def _create_deployment(cls, app_id, instance_id, inputs, retries=3):
+    @staticmethod
+    def _create_deployment(app_id, instance_id, inputs):
+        """ Deployment environment errors are raised to retry later """
         error = None
         deployment = None
 
@@ -506,15 +791,8 @@ class AppInstance(models.Model):
                 skip_plugins_validation=True
             )
         except (DeploymentEnvironmentCreationPendingError,
-                DeploymentEnvironmentCreationInProgressError) as err:
-            if (retries > 0):
-                time.sleep(WAIT_FOR_EXECUTION_SLEEP_INTERVAL)
-                deployment, error = cls._create_deployment(app_id,
-                                                           instance_id,
-                                                           inputs,
-                                                           retries - 1)
-            LOGGER.exception(err)
-            error = str(err)
+                DeploymentEnvironmentCreationInProgressError):
+            raise
         except CloudifyClientError as err:
             LOGGER.exception(err)
             error = str(err)
@@ -554,6 +832,11 @@ class WorkflowExecution(models.Model):
     UNINSTALL = 'uninstall'
     DESTROY = 'destroy'
 
+    # the orchestrator does not know the execution anymore, i.e. its
+    # deployment was deleted
+    MISSING = 'missing'
+    END_STATES = Execution.END_STATES + [MISSING]
+
     id_code = models.CharField(max_length=50)
     app_instance = models.ForeignKey(
         AppInstance,
@@ -563,6 +846,10 @@ class WorkflowExecution(models.Model):
     # can't use auto_now_add because it set editable=False
     # and therefore model_to_dict skips the field
     created_on = models.DateTimeField(editable=True)
+    status = models.CharField(max_length=20, null=True, db_index=True)
+    ended_on = models.DateTimeField(null=True, editable=True)
+    # True once the execution is terminal and all its events are stored
+    events_synced = models.BooleanField(default=False)
 
     owner = models.ForeignKey(
         settings.AUTH_USER_MODEL,
@@ -653,6 +940,7 @@ class WorkflowExecution(models.Model):
                     app_instance=instance,
                     workflow=workflow,
                     created_on=datetime.now(),
+                    status=execution['status'],
                     owner=owner)
             except Exception as err:
                 LOGGER.exception(err)
@@ -664,6 +952,161 @@ class WorkflowExecution(models.Model):
         else:
             return {'execution': _to_dict(execution), 'error': error}
 
+    @classmethod
+    def create_batch(cls, instance_pks, workflow, owner,
+                     force=False, params=None, return_dict=False):
+        """ Starts the workflow on several instances at once
+
+        The orchestrator calls are made concurrently by a bounded pool of
+        threads, and the executions started are stored all together.
+        Returns a list with the execution and error of each instance, in
+        the same order, and a string error.
+        """
+        error = None
+        results = [{'instance': pk, 'execution': None, 'error': None}
+                   for pk in instance_pks]
+
+        instances = AppInstance.objects.in_bulk(instance_pks)
+        started = []
+        for result in results:
+            instance = instances.get(result['instance'])
+            if instance is None:
+                result['error'] = \
+                    "Can't create execution because instance doesn't exists"
+            elif instance.owner != owner:
+                result['error'] = 'Instance does not belong to user'
+            else:
+                started.append(result)
+        if not started:
+            return cls._batch_response(results, error, return_dict)
+
+        def execute(result):
+            return cls._execute_workflow(instances[result['instance']].name,
+                                         workflow,
+                                         force,
+                                         params)
+
+        workers = min(settings.EXECUTIONS_BATCH_WORKERS, len(started))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            responses = list(executor.map(execute, started))
+
+        executions = []
+        now = datetime.now()
+        for result, (execution, execution_error) in zip(started, responses):
+            if execution_error is not None:
+                result['error'] = execution_error
+                continue
+            result['execution'] = execution['id']
+            executions.append(cls(
+                id_code=execution['id'],
+                app_instance=instances[result['instance']],
+                workflow=workflow,
+                created_on=now,
+                status=execution['status'],
+                owner=owner))
+
+        if executions:
+            try:
+                cls.objects.bulk_create(executions)
+                # bulk_create does not set the primary keys on every backend
+                stored = {execution.id_code: execution
+                          for execution in cls.objects.filter(
+                              id_code__in=[item.id_code
+                                           for item in executions])}
+                for result in started:
+                    if result['execution'] is not None:
+                        result['execution'] = \
+                            stored.get(result['execution'])
+            except Exception as err:
+                LOGGER.exception(err)
+                error = str(err)
+                # executions that can't be tracked must not keep running
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    cancel_errors = list(executor.map(
+                        lambda execution: cls._cancel_execution(
+                            execution.id_code),
+                        executions))
+                # executions were started, and are listed, in order
+                failed = [result for result in started
+                          if result['error'] is None]
+                for result, cancel_error in zip(failed, cancel_errors):
+                    result['execution'] = None
+                    result['error'] = "Couldn't store the execution: " + \
+                        error
+                    if cancel_error is not None:
+                        result['error'] += ", nor cancel it: " + cancel_error
+
+        return cls._batch_response(results, error, return_dict)
+
+    @staticmethod
+    def _batch_response(results, error, return_dict):
+        if not return_dict:
+            return (results, error)
+        else:
+            return {
+                'results': [{'instance': result['instance'],
+                             'execution': _to_dict(result['execution']),
+                             'error': result['error']}
+                            for result in results],
+                'error': error}
+
+    @classmethod
+    def sync_statuses(cls):
+        """ Updates status and end time of the executions not finished yet
+
+        The orchestrator is asked in bulk, and only the executions that
+        changed are written, all in one transaction. Terminal executions
+        are not tracked anymore. Returns the number of executions updated,
+        and a string error.
+        """
+        error = None
+        updated = 0
+        tracked = {execution.id_code: execution
+                   for execution in cls.objects.exclude(
+                       status__in=cls.END_STATES)}
+        if not tracked:
+            return (updated, error)
+
+        changed = []
+        client = _get_client()
+        ids = list(tracked.keys())
+        try:
+            for index in range(0, len(ids), STATUS_SYNC_BATCH_SIZE):
+                batch = ids[index:index + STATUS_SYNC_BATCH_SIZE]
+                missing = set(batch)
+                for item in client.executions.list(id=batch,
+                                                   _size=len(batch)):
+                    missing.discard(item.id)
+                    execution = tracked[item.id]
+                    if execution.status == item.status:
+                        continue
+                    execution.status = item.status
+                    if cls._is_execution_finished(item.status):
+                        execution.ended_on = \
+                            _parse_timestamp(item.get('ended_at')) or \
+                            timezone.now()
+                    changed.append(execution)
+                for execution_id in missing:
+                    # not listed anymore, so it can't end or log events
+                    execution = tracked[execution_id]
+                    execution.status = cls.MISSING
+                    execution.ended_on = timezone.now()
+                    execution.events_synced = True
+                    changed.append(execution)
+        except (CloudifyClientError,
+                requests.exceptions.RequestException) as err:
+            LOGGER.exception(err)
+            error = str(err)
+
+        with transaction.atomic():
+            for execution in changed:
+                execution.save(update_fields=['status',
+                                              'ended_on',
+                                              'events_synced'])
+                updated += 1
+
+        return (updated, error)
+
     def __str__(self):
         return "Workflow execution {0}:{1} [{2}] from {3}".format(
             self.workflow,
@@ -688,6 +1131,20 @@ class WorkflowExecution(models.Model):
 
         return (execution, error)
 
+    @staticmethod
+    def _cancel_execution(execution_id):
+        """ Cancels a started execution, returns a string error """
+        error = None
+
+        client = _get_client()
+        try:
+            client.executions.cancel(execution_id)
+        except CloudifyClientError as err:
+            LOGGER.exception(err)
+            error = str(err)
+
+        return error
+
     @classmethod
     def get_execution_events(cls, execution_pk, offset, owner,
                              return_dict=False):
@@ -698,33 +1155,100 @@ class WorkflowExecution(models.Model):
                 error = \
                     "Can't get execution events because it doesn't exists"
             else:
-                events = cls._get_execution_events(
-                    wf_execution.id_code,
-                    offset)
+                events = wf_execution._get_execution_events(offset)
 
         if not return_dict:
             return (events, error)
         else:
             return {'events': events, 'error': error}
 
-    @staticmethod
-    def _get_execution_events(execution_id, offset):
-        client = _get_client()
+    @classmethod
+    def stream_execution_events(cls, execution_pk, offset, owner):
+        """ Returns a generator of server-sent events, and a string error """
+        events = None
+        wf_execution, error = cls.get(execution_pk, owner)
+        if error is None:
+            if wf_execution is None:
+                error = \
+                    "Can't get execution events because it doesn't exists"
+            else:
+                events = streams.execution_events(
+                    wf_execution.id_code,
+                    wf_execution._get_execution_events,
+                    offset)
+
+        return (events, error)
 
-        execution = client.executions.get(execution_id)
-        events = client.events.list(execution_id=execution_id,
-                                    _offset=offset,
-                                    _size=100)
-        last_message = events.metadata.pagination.total
+    def _get_execution_events(self, offset):
+        """ Reads the execution log from the local events table
+
+        New events are copied from the orchestrator first, unless the local
+        copy is already complete. If the orchestrator can't be reached, the
+        events stored so far are served.
+        """
+        try:
+            self._sync_events()
+        except (CloudifyClientError,
+                requests.exceptions.RequestException) as err:
+            LOGGER.exception(err)
+
+        logs = list(self.executionevent_set.filter(
+            sequence__gte=offset).values_list('message', flat=True))
 
         return {
-            'logs': WorkflowExecution._events_to_string(events.items),
-            'last': last_message,
-            'status': execution.status,
-            'finished': WorkflowExecution._is_execution_finished(
-                execution.status)
+            'logs': logs,
+            'last': offset + len(logs),
+            'status': self.status,
+            'finished': self.events_synced
         }
 
+    def _sync_events(self):
+        """ Copies the events not stored yet from the orchestrator
+
+        The number of events stored is the high-water mark, and the
+        pagination total of the orchestrator tells when all were copied.
+        Events can still arrive shortly after the execution ends, so the
+        local copy is only considered complete when a sync after seeing
+        the execution terminal finds nothing new.
+        """
+        if self.events_synced:
+            return
+
+        was_finished = self._is_execution_finished(self.status)
+        client = _get_client()
+        execution = client.executions.get(self.id_code)
+
+        stored = self.executionevent_set.count()
+        new_events = 0
+        while True:
+            events = client.events.list(execution_id=self.id_code,
+                                        _offset=stored,
+                                        _size=EVENTS_PAGE_SIZE)
+            if not events.items:
+                break
+            try:
+                with transaction.atomic():
+                    ExecutionEvent.objects.bulk_create([
+                        ExecutionEvent(execution=self,
+                                       sequence=stored + index,
+                                       message=message)
+                        for index, message in enumerate(
+                            self._events_to_string(events.items))])
+            except IntegrityError:
+                # another request stored them concurrently
+                pass
+            stored = self.executionevent_set.count()
+            new_events += len(events.items)
+            if stored >= events.metadata.pagination.total:
+                break
+
+        self.status = execution.status
+        if self._is_execution_finished(self.status) and self.ended_on is None:
+            self.ended_on = _parse_timestamp(execution.get('ended_at')) or \
+                timezone.now()
+        self.events_synced = was_finished and new_events == 0
+        self.save(update_fields=['status', 'ended_on', 'events_synced'])
+
     @staticmethod
     def _events_to_string(events):
         response = []
@@ -767,4 +1291,342 @@ class WorkflowExecution(models.Model):
 
     @staticmethod
     def _is_execution_finished(status):
-        return status in Execution.END_STATES
+        return status in WorkflowExecution.END_STATES
+
+
+class ExecutionEvent(models.Model):
+    """ Local copy of the orchestrator events of a workflow execution """
+    execution = models.ForeignKey(
+        WorkflowExecution,
+        on_delete=models.CASCADE,
+    )
+    sequence = models.PositiveIntegerField()
+    message = models.TextField()
+
+    class Meta:
+        unique_together = (('execution', 'sequence'),)
+        ordering = ('sequence',)
+
+    def __str__(self):
+        return "Event {0} of {1}".format(
+            self.sequence,
+            self.execution.id_code)
+
+
+_DATASET_FTS_READY = False
+
+
+def _get_dataset_fts_table():
+    return Dataset._meta.db_table + '_fts'
+
+
+def _create_dataset_fts():
+    """ Creates the full-text index of the datasets if it does not exist,
+    returns if it can be used
+
+    It is a SQLite FTS5 table kept up to date by triggers, that can't be
+    described by the models, so the datasets synchronization creates it.
+    """
+    if connection.vendor != 'sqlite':
+        return False
+
+    table = Dataset._meta.db_table
+    fts_table = _get_dataset_fts_table()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT name FROM sqlite_master WHERE type='table' "
+                "AND name=%s", [fts_table])
+            if cursor.fetchone() is None:
+                cursor.execute(
+                    "CREATE VIRTUAL TABLE {0} USING fts5(name, title, "
+                    "content='{1}', content_rowid='id')"
+                    .format(fts_table, table))
+                cursor.execute(
+                    "CREATE TRIGGER {1}_ai AFTER INSERT ON {1} BEGIN "
+                    "INSERT INTO {0}(rowid, name, title) "
+                    "VALUES (new.id, new.name, new.title); END"
+                    .format(fts_table, table))
+                cursor.execute(
+                    "CREATE TRIGGER {1}_ad AFTER DELETE ON {1} BEGIN "
+                    "INSERT INTO {0}({0}, rowid, name, title) "
+                    "VALUES ('delete', old.id, old.name, old.title); END"
+                    .format(fts_table, table))
+                cursor.execute(
+                    "CREATE TRIGGER {1}_au AFTER UPDATE ON {1} BEGIN "
+                    "INSERT INTO {0}({0}, rowid, name, title) "
+                    "VALUES ('delete', old.id, old.name, old.title); "
+                    "INSERT INTO {0}(rowid, name, title) "
+                    "VALUES (new.id, new.name, new.title); END"
+                    .format(fts_table, table))
+                # index the rows that already exist
+                cursor.execute(
+                    "INSERT INTO {0}({0}) VALUES ('rebuild')"
+                    .format(fts_table))
+    except DatabaseError as err:
+        # i.e. SQLite built without FTS5
+        LOGGER.warning("Can't create the datasets index: " + str(err))
+        return False
+    return True
+
+
+def _has_dataset_fts():
+    """ Returns if the full-text index of the datasets was created """
+    global _DATASET_FTS_READY
+    if _DATASET_FTS_READY:
+        return True
+    if connection.vendor != 'sqlite':
+        return False
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' "
+            "AND name=%s", [_get_dataset_fts_table()])
+        _DATASET_FTS_READY = cursor.fetchone() is not None
+    return _DATASET_FTS_READY
+
+
+class Dataset(models.Model):
+    """ CKAN dataset, indexed locally to search it """
+    ckan_id = models.CharField(max_length=50, unique=True)
+    name = models.CharField(max_length=100, db_index=True)
+    title = models.CharField(max_length=256, null=True)
+    metadata_modified = models.CharField(max_length=50, null=True)
+
+    @classmethod
+    def get(cls, pk, return_dict=False):
+        error = None
+        dataset = None
+        try:
+            dataset = cls.objects.get(pk=pk)
+        except cls.DoesNotExist:
+            error = 'Dataset does not exist'
+
+        if not return_dict:
+            return (dataset, error)
+        else:
+            return {'dataset': _to_dict(dataset), 'error': error}
+
+    @classmethod
+    def search(cls, query='', page=0, page_size=50, return_dict=False):
+        """ Returns a page of the datasets whose name or title have words
+        starting with the ones in query, the total number of them, and a
+        string error """
+        error = None
+        dataset_list = []
+        count = 0
+
+        datasets = cls.objects.order_by('name')
+        terms = re.findall(r'\w+', query or '')
+        if terms:
+            if _has_dataset_fts():
+                match = ' '.join('"' + term + '"*' for term in terms)
+                # pk__in=RawSQL() would compare against the first row only
+                datasets = datasets.extra(
+                    where=['{0}.id IN (SELECT rowid FROM {0}_fts '
+                           'WHERE {0}_fts MATCH %s)'
+                           .format(cls._meta.db_table)],
+                    params=[match])
+            else:
+                for term in terms:
+                    datasets = datasets.filter(Q(name__icontains=term) |
+                                               Q(title__icontains=term))
+        try:
+            count = datasets.count()
+            dataset_list = list(
+                datasets[page * page_size:(page + 1) * page_size])
+        except DatabaseError as err:
+            LOGGER.exception(err)
+            error = str(err)
+
+        if not return_dict:
+            return (dataset_list, count, error)
+        else:
+            return {'dataset_list': [{'id': dataset.pk,
+                                      'name': dataset.name,
+                                      'title': dataset.title}
+                                     for dataset in dataset_list],
+                    'count': count,
+                    'page': page,
+                    'page_size': page_size,
+                    'error': error}
+
+    def __str__(self):
+        return "Dataset {0}".format(self.name)
+
+
+class Job(models.Model):
+    """ Orchestrator operation run in background by the jobs workers """
+    CREATE_DEPLOYMENT = 'create_deployment'
+    UPLOAD_BLUEPRINT = 'upload_blueprint'
+    CREATE_SWEEP = 'create_sweep'
+    KIND_CHOICES = (
+        (CREATE_DEPLOYMENT, 'Create deployment'),
+        (UPLOAD_BLUEPRINT, 'Upload blueprint'),
+        (CREATE_SWEEP, 'Create sweep'),
+    )
+    kind = models.CharField(max_length=30, choices=KIND_CHOICES)
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+    status = models.CharField(
+        max_length=10,
+        choices=STATUS_CHOICES,
+        default=PENDING,
+        db_index=True,
+    )
+
+    # json encoded, cleared once the job ends as it may hold credentials
+    payload = models.TextField()
+    result = models.TextField(null=True)
+    error = models.TextField(null=True)
+    attempts = models.PositiveIntegerField(default=0)
+    # percentage of the operation done, if the operation reports it
+    progress = models.PositiveSmallIntegerField(default=0)
+    run_after = models.DateTimeField(editable=True, db_index=True)
+    created_on = models.DateTimeField(editable=True)
+    updated_on = models.DateTimeField(editable=True)
+
+    owner = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+    )
+
+    @classmethod
+    def enqueue(cls, kind, payload, owner, return_dict=False):
+        error = None
+        job = None
+        now = timezone.now()
+        try:
+            job = cls.objects.create(kind=kind,
+                                     payload=json.dumps(payload),
+                                     run_after=now,
+                                     created_on=now,
+                                     updated_on=now,
+                                     owner=owner)
+        except Exception as err:
+            LOGGER.exception(err)
+            error = str(err)
+
+        if not return_dict:
+            return (job, error)
+        else:
+            return {'job': cls._job_to_dict(job), 'error': error}
+
+    @classmethod
+    def get(cls, pk, owner, return_dict=False):
+        error = None
+        job = None
+        try:
+            job = cls.objects.get(pk=pk)
+        except cls.DoesNotExist:
+            pass
+
+        if job is not None and owner != job.owner:
+            job = None
+            error = 'Job does not belong to user'
+
+        if not return_dict:
+            return (job, error)
+        else:
+            return {'job': cls._job_to_dict(job), 'error': error}
+
+    @classmethod
+    def claim(cls):
+        """ Takes the next job ready to run, or None if there is none
+
+        Several workers may race for the same job, only the one that
+        changes its status from pending gets it.
+        """
+        now = timezone.now()
+        candidates = cls.objects.filter(
+            status=cls.PENDING,
+            run_after__lte=now).order_by('run_after').values_list(
+                'pk', flat=True)[:10]
+        for pk in candidates:
+            if cls.objects.filter(pk=pk, status=cls.PENDING).update(
+                    status=cls.RUNNING,
+                    attempts=F('attempts') + 1,
+                    updated_on=now) == 1:
+                return cls.objects.get(pk=pk)
+        return None
+
+    @classmethod
+    def get_upload_digests(cls):
+        """ Returns the digests of the packages of the uploads not ended """
+        digests = set()
+        for payload in cls.objects.filter(
+                kind=cls.UPLOAD_BLUEPRINT,
+                status__in=[cls.PENDING, cls.RUNNING]).values_list(
+                    'payload', flat=True):
+            digest = json.loads(payload).get('digest')
+            if digest is not None:
+                digests.add(digest)
+        return digests
+
+    @classmethod
+    def requeue_running(cls):
+        """ Jobs left running by a stopped worker are run again """
+        return cls.objects.filter(status=cls.RUNNING).update(
+            status=cls.PENDING,
+            updated_on=timezone.now())
+
+    def retry(self, error, delay):
+        """ Runs the job again after delay seconds """
+        now = timezone.now()
+        self.status = self.PENDING
+        self.error = error
+        self.run_after = now + timedelta(seconds=delay)
+        self.updated_on = now
+        self.save()
+
+    def set_progress(self, progress):
+        if progress != self.progress:
+            self.progress = progress
+            Job.objects.filter(pk=self.pk).update(progress=progress,
+                                                  updated_on=timezone.now())
+
+    def finish(self, result):
+        self.progress = 100
+        self._end(self.DONE, result=json.dumps(result, cls=DjangoJSONEncoder))
+
+    def fail(self, error):
+        self._end(self.FAILED, error=error)
+
+    def _end(self, status, result=None, error=None):
+        self.status = status
+        self.result = result
+        self.error = error
+        self.payload = '{}'
+        self.updated_on = timezone.now()
+        self.save()
+
+    @staticmethod
+    def _job_to_dict(job):
+        if job is None:
+            return None
+        return {
+            'id': job.pk,
+            'kind': job.kind,
+            'status': job.status,
+            'attempts': job.attempts,
+            'progress': job.progress,
+            'result': json.loads(job.result) if job.result else None,
+            'error': job.error,
+            'created_on': job.created_on,
+            'updated_on': job.updated_on,
+        }
+
+    def __str__(self):
+        return "Job {0} [{1}] from {2}".format(
+            self.kind,
+            self.status,
+            self.owner.username)
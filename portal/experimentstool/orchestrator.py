@@ -0,0 +1,162 @@
+""" Orchestrator client pool module
+
+Keeps one Cloudify client per worker process whose requests go through a
+shared keep-alive session, so consecutive orchestrator calls reuse the
+already opened TCP/TLS connections instead of opening new ones.
+"""
+
+import os
+import time
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from django.conf import settings
+
+from cloudify_rest_client import CloudifyClient
+from cloudify_rest_client.client import HTTPClient
+
+
+# Get an instance of a logger
+LOGGER = logging.getLogger(__name__)
+
+
+class _PooledHTTPClient(HTTPClient):
+    """ Cloudify HTTP client that sends every request through a session """
+    session = None
+
+    def _do_request(self, requests_method, *args, **kwargs):
+        if self.session is not None:
+            # requests.get -> session.get, requests.put -> session.put, ...
+            requests_method = getattr(self.session, requests_method.__name__)
+        return super(_PooledHTTPClient, self)._do_request(
+            requests_method, *args, **kwargs)
+
+
+class _PooledCloudifyClient(CloudifyClient):
+    client_class = _PooledHTTPClient
+
+    def __init__(self, session, **kwargs):
+        super(_PooledCloudifyClient, self).__init__(**kwargs)
+        self._client.session = session
+
+
+class ClientPool(object):
+    """ Process-wide orchestrator client with a keep-alive connection pool
+
+    Connections idle for more than `idle_timeout` seconds are dropped (the
+    orchestrator nginx closes them anyway), and a fresh pool is created on
+    the next call. Hits count requests served by a reused connection,
+    misses count requests that had to open a new one.
+    """
+
+    def __init__(self, size, idle_timeout):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._session = None
+        self._client = None
+        self._last_used = 0
+        # counters of the sessions already evicted
+        self._requests = 0
+        self._connections = 0
+        self._evictions = 0
+
+    def get(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._client is not None and \
+                    now - self._last_used > self.idle_timeout:
+                LOGGER.debug('Evicting idle orchestrator connections')
+                self._evict()
+            if self._client is None:
+                self._session = self._new_session()
+                self._client = _PooledCloudifyClient(
+                    self._session,
+                    host=settings.ORCHESTRATOR_HOST,
+                    username=settings.ORCHESTRATOR_USER,
+                    password=settings.ORCHESTRATOR_PASS,
+                    tenant=settings.ORCHESTRATOR_TENANT)
+            self._last_used = now
+            return self._client
+
+    def clear(self):
+        with self._lock:
+            if self._client is not None:
+                self._evict()
+
+    def stats(self):
+        with self._lock:
+            requests_num, connections_num = self._session_counters()
+            requests_num += self._requests
+            connections_num += self._connections
+            return {
+                'pool_size': self.size,
+                'idle_timeout': self.idle_timeout,
+                'requests': requests_num,
+                'hits': requests_num - connections_num,
+                'misses': connections_num,
+                'evictions': self._evictions,
+            }
+
+    def _new_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=self.size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def _evict(self):
+        requests_num, connections_num = self._session_counters()
+        self._requests += requests_num
+        self._connections += connections_num
+        self._evictions += 1
+        self._session.close()
+        self._session = None
+        self._client = None
+
+    def _session_counters(self):
+        requests_num = 0
+        connections_num = 0
+        if self._session is not None:
+            for adapter in set(self._session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools.get(key)
+                    if pool is not None:
+                        requests_num += pool.num_requests
+                        connections_num += pool.num_connections
+        return (requests_num, connections_num)
+
+
+_POOL = None
+_POOL_PID = None
+_POOL_LOCK = threading.Lock()
+
+
+def _get_pool():
+    global _POOL, _POOL_PID
+    pid = os.getpid()
+    # uwsgi forks the workers, sockets can't be shared with the parent
+    if _POOL is None or _POOL_PID != pid:
+        with _POOL_LOCK:
+            if _POOL is None or _POOL_PID != pid:
+                _POOL = ClientPool(settings.ORCHESTRATOR_POOL_SIZE,
+                                   settings.ORCHESTRATOR_POOL_IDLE_TIMEOUT)
+                _POOL_PID = pid
+    return _POOL
+
+
+def get_client():
+    """ Returns the pooled orchestrator client of this worker """
+    return _get_pool().get()
+
+
+def get_stats():
+    """ Returns the hit/miss counters of this worker connection pool """
+    stats = _get_pool().stats()
+    stats['pid'] = os.getpid()
+    return stats
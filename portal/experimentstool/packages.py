@@ -0,0 +1,88 @@
+""" Blueprint packages module
+
+Uploaded packages are kept in a content-addressed store owned by the portal:
+each package is saved once, named after its sha256 digest, no matter how
+many times or under which application name it is uploaded. Packages stay
+in the store while an application references them.
+"""
+
+import os
+import time
+import uuid
+import hashlib
+import logging
+
+from django.conf import settings
+from django.core.files.move import file_move_safe
+
+
+# Get an instance of a logger
+LOGGER = logging.getLogger(__name__)
+
+_CHUNK_SIZE = 64 * 1024
+_INCOMING_DIR = 'incoming'
+
+
+def store(uploaded_file):
+    """ Saves an uploaded package in the store, returns its digest """
+    incoming_dir = os.path.join(settings.BLUEPRINT_STORE_DIR, _INCOMING_DIR)
+    os.makedirs(incoming_dir, exist_ok=True)
+    incoming_path = os.path.join(incoming_dir, uuid.uuid4().hex)
+    sha256 = hashlib.sha256()
+
+    if hasattr(uploaded_file, 'temporary_file_path'):
+        # Django already wrote it to disk, just move it
+        file_move_safe(uploaded_file.temporary_file_path(), incoming_path)
+        with open(incoming_path, 'rb') as package_file:
+            for chunk in iter(lambda: package_file.read(_CHUNK_SIZE), b''):
+                sha256.update(chunk)
+    else:
+        with open(incoming_path, 'wb') as package_file:
+            for chunk in uploaded_file.chunks():
+                sha256.update(chunk)
+                package_file.write(chunk)
+
+    digest = sha256.hexdigest()
+    package_path = path(digest)
+    if os.path.exists(package_path):
+        os.remove(incoming_path)
+        # uploaded again, so it is not old for the cleaning anymore
+        os.utime(package_path)
+    else:
+        os.makedirs(os.path.dirname(package_path), exist_ok=True)
+        os.replace(incoming_path, package_path)
+
+    return digest
+
+
+def path(digest):
+    """ Path of the package with this digest in the store """
+    return os.path.join(settings.BLUEPRINT_STORE_DIR,
+                        digest[:2],
+                        digest + '.tar.gz')
+
+
+def remove(digest):
+    """ Removes a package from the store """
+    try:
+        os.remove(path(digest))
+    except FileNotFoundError:
+        pass
+
+
+def clean(max_age, keep):
+    """ Removes the packages older than max_age seconds whose digest is not
+    in keep, as well as uploads that never made it to the store """
+    if not os.path.isdir(settings.BLUEPRINT_STORE_DIR):
+        return
+    limit = time.time() - max_age
+    for root, _, names in os.walk(settings.BLUEPRINT_STORE_DIR):
+        for name in names:
+            file_path = os.path.join(root, name)
+            digest = name.split('.')[0]
+            if digest not in keep and os.path.getmtime(file_path) < limit:
+                LOGGER.warning('Removing unused package ' + file_path)
+                try:
+                    os.remove(file_path)
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,250 @@
+""" Server-sent events module
+
+Viewers of the same workflow execution share a single upstream poller, a
+thread that asks the orchestrator for new events and wakes every viewer
+stream up when they arrive. The poller stops by itself once the execution
+has finished or nobody is watching anymore.
+
+Each open stream holds a worker thread, so a worker serves at most
+STREAMS_PER_WORKER of them at once. Viewers past the limit get a `busy`
+event and poll the log instead.
+"""
+
+import json
+import time
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connection
+from django.http import StreamingHttpResponse
+
+
+# Get an instance of a logger
+LOGGER = logging.getLogger(__name__)
+
+POLL_INTERVAL = 3
+KEEPALIVE_INTERVAL = 15
+# seconds a poller keeps polling without any viewer attached
+IDLE_TIMEOUT = 30
+
+
+class EventsPoller(object):
+    """ Polls the events of one execution on behalf of all its viewers
+
+    `fetch(offset)` must return a dict with the `logs` found from offset,
+    the `last` (total) number of events, the execution `status` and if it
+    is `finished`, as `WorkflowExecution._get_execution_events` does.
+    """
+
+    def __init__(self, key, fetch):
+        self.key = key
+        self._fetch = fetch
+        self._condition = threading.Condition()
+        self._viewers = 0
+        self._last_viewed = time.monotonic()
+        self.logs = []
+        self.total = None
+        self.status = None
+        self.finished = False
+        self.error = None
+        self.done = False
+        self._thread = threading.Thread(target=self._run,
+                                        name='events-' + str(key),
+                                        daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def attach(self):
+        with self._condition:
+            self._viewers += 1
+
+    def detach(self):
+        with self._condition:
+            self._viewers -= 1
+            self._last_viewed = time.monotonic()
+
+    def wait(self, cursor, timeout):
+        """ Blocks until there are logs after cursor, or timeout expires """
+        with self._condition:
+            if len(self.logs) <= cursor and not self.done:
+                self._condition.wait(timeout)
+            return (self.logs[cursor:],
+                    self.status,
+                    self.finished and len(self.logs) >= (self.total or 0),
+                    self.error,
+                    self.done)
+
+    def _is_abandoned(self):
+        with self._condition:
+            return self._viewers <= 0 and \
+                time.monotonic() - self._last_viewed > IDLE_TIMEOUT
+
+    def _run(self):
+        try:
+            while not self._is_abandoned():
+                try:
+                    data = self._fetch(len(self.logs))
+                except Exception as err:
+                    LOGGER.exception(err)
+                    with self._condition:
+                        self.error = str(err)
+                        self._condition.notify_all()
+                    time.sleep(POLL_INTERVAL)
+                    continue
+
+                with self._condition:
+                    self.logs.extend(data['logs'])
+                    self.total = data['last']
+                    self.status = data['status']
+                    self.finished = data['finished']
+                    self.error = None
+                    self._condition.notify_all()
+                    pending = len(self.logs) < self.total
+
+                if self.finished and not pending:
+                    break
+                if not pending or not data['logs']:
+                    time.sleep(POLL_INTERVAL)
+        finally:
+            # fetching may have opened a database connection in this thread
+            connection.close()
+            _release_poller(self)
+            with self._condition:
+                self.done = True
+                self._condition.notify_all()
+
+
+_POLLERS = {}
+_POLLERS_LOCK = threading.Lock()
+
+
+def _acquire_poller(key, fetch):
+    with _POLLERS_LOCK:
+        poller = _POLLERS.get(key)
+        if poller is None:
+            poller = EventsPoller(key, fetch)
+            _POLLERS[key] = poller
+            poller.start()
+        poller.attach()
+    return poller
+
+
+def _release_poller(poller):
+    with _POLLERS_LOCK:
+        if _POLLERS.get(poller.key) is poller:
+            del _POLLERS[poller.key]
+
+
+def _to_event(data, event=None, event_id=None):
+    message = ''
+    if event_id is not None:
+        message += 'id: ' + str(event_id) + '\n'
+    if event is not None:
+        message += 'event: ' + event + '\n'
+    return message + 'data: ' + json.dumps(data) + '\n\n'
+
+
+def execution_events(key, fetch, offset=0):
+    """ Generator of the server-sent events of an execution log
+
+    Every log line is sent as a message whose id is its position in the log,
+    so browsers reconnecting with `Last-Event-ID` resume where they were.
+    """
+    poller = _acquire_poller(key, fetch)
+    try:
+        cursor = offset
+        status = None
+        last_error = None
+        while True:
+            logs, new_status, finished, error, done = \
+                poller.wait(cursor, KEEPALIVE_INTERVAL)
+
+            for log in logs:
+                yield _to_event(log, event_id=cursor)
+                cursor += 1
+
+            if new_status != status:
+                status = new_status
+                yield _to_event({'status': status, 'finished': finished},
+                                event='status')
+
+            if finished:
+                yield _to_event({'status': status}, event='finished')
+                break
+
+            if error is not None and error != last_error:
+                yield _to_event({'error': error}, event='failure')
+            last_error = error
+
+            if done:
+                # poller went away without finishing, start a new one
+                poller.detach()
+                poller = _acquire_poller(key, fetch)
+            elif not logs:
+                # comment line, keeps proxies from closing the connection
+                yield ': keepalive\n\n'
+    finally:
+        poller.detach()
+
+
+_STREAMS = None
+_STREAMS_LOCK = threading.Lock()
+
+
+def _get_streams_semaphore():
+    global _STREAMS
+    with _STREAMS_LOCK:
+        if _STREAMS is None:
+            _STREAMS = threading.BoundedSemaphore(
+                settings.STREAMS_PER_WORKER)
+    return _STREAMS
+
+
+class _LimitedStream(object):
+    """ Holds one of the worker stream slots until the response is closed,
+    even if it is never iterated """
+
+    def __init__(self, events, semaphore):
+        self._events = events
+        self._semaphore = semaphore
+        self._released = False
+
+    def __iter__(self):
+        return iter(self._events)
+
+    def close(self):
+        if not self._released:
+            self._released = True
+            self._events.close()
+            self._semaphore.release()
+
+
+def limit_streams(events):
+    """ Returns the events if this worker has a free stream slot, or a
+    single `busy` event so the client polls instead """
+    semaphore = _get_streams_semaphore()
+    if not semaphore.acquire(blocking=False):
+        events.close()
+        return busy_events()
+    return _LimitedStream(events, semaphore)
+
+
+def busy_events():
+    """ Generator of a single busy notice, clients must poll instead """
+    yield _to_event({'busy': True}, event='busy')
+
+
+def error_events(error):
+    """ Generator of a single fatal error, clients must not reconnect """
+    yield _to_event({'error': error, 'fatal': True}, event='failure')
+
+
+def event_stream_response(events):
+    response = StreamingHttpResponse(events,
+                                     content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # do not let nginx buffer the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
@@ -20,14 +20,26 @@ urlpatterns = [
         views.get_dataset_info, name='_get_dataset_info'),
     url(r'^_deploy_application$',
         views.create_deployment, name='_deploy_application'),
+    url(r'^_create_sweep$',
+        views.create_sweep, name='_create_sweep'),
+    url(r'^_get_sweep$',
+        views.get_sweep, name='_get_sweep'),
+    url(r'^_get_sweeps$',
+        views.get_sweeps, name='_get_sweeps'),
+    url(r'^_get_job$',
+        views.get_job, name='_get_job'),
     url(r'^_get_deployments$',
         views.get_deployments, name='_get_deployments'),
     url(r'^_get_executions$',
         views.get_executions, name='_get_executions'),
     url(r'^_execute_deployment$',
         views.execute_deployment, name='_execute_deployment'),
+    url(r'^_execute_deployments$',
+        views.execute_deployments, name='_execute_deployments'),
     url(r'^_get_executions_events$',
         views.get_executions_events, name='_get_executions_events'),
+    url(r'^_stream_executions_events$',
+        views.stream_executions_events, name='_stream_executions_events'),
     url(r'^_destroy_deployment$',
         views.destroy_deployment, name='_destroy_deployment'),
     url(r'^_remove_application$',
@@ -38,4 +50,8 @@ urlpatterns = [
         views.add_hpc, name='_add_hpc'),
     url(r'^_delete_hpc$',
         views.delete_hpc, name='_delete_hpc'),
+    url(r'^_get_orchestrator_stats$',
+        views.get_orchestrator_stats, name='_get_orchestrator_stats'),
+    url(r'^_get_http_stats$',
+        views.get_http_stats, name='_get_http_stats'),
 ]
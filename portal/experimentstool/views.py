@@ -1,24 +1,37 @@
 """ Experiments Tool views module """
 
-import re
 import json
-import tempfile
-import requests
-
-from urllib.parse import urlparse
+import logging
 
 from django.contrib.auth.decorators import login_required, permission_required
+from django.contrib.admin.views.decorators import staff_member_required
 from django.shortcuts import render
 from django.http import JsonResponse
 
 import sso
 from sso.utils import token_required
 from portal import settings
-
+from portal import http_client
+from portal import payloads
+
+from experimentstool import datasets
+from experimentstool import marketplace
+from experimentstool import orchestrator
+from experimentstool import packages
+from experimentstool import streams
+from experimentstool.inputs import InputsResolver
 from experimentstool.models import (Application,
                                     AppInstance,
                                     WorkflowExecution,
-                                    HPCInfrastructure)
+                                    HPCInfrastructure,
+                                    Job,
+                                    Sweep,
+                                    ProductSpecification,
+                                    Dataset)
+
+
+# Get an instance of a logger
+LOGGER = logging.getLogger(__name__)
 
 
 @login_required
@@ -31,6 +44,16 @@ def experimentstool(request):
     return render(request, 'experimentstool.html', context)
 
 
+@staff_member_required
+def get_orchestrator_stats(request):
+    return JsonResponse(orchestrator.get_stats())
+
+
+@staff_member_required
+def get_http_stats(request):
+    return JsonResponse(http_client.get_stats())
+
+
 @login_required
 def get_hpc_list(request):
     return JsonResponse(
@@ -95,31 +118,17 @@ def get_new_stock(request, *args, **kwargs):
         return JsonResponse({'redirect': kwargs['url']+'/experimentstool/'})
     uid = sso.utils.get_uid(request.user)
 
-    stock_data = _get_stock(access_token, uid)
-    if 'error' in stock_data:
-        return JsonResponse(stock_data, safe=False)
-
-    marketplace_ids = []
-    for product in stock_data:
-        marketplace_ids.append(_get_productid_from_specification(product))
-
-    applications, error = Application.list(marketplace_ids)
+    error = marketplace.ensure_synced(access_token, uid)
     if error is not None:
         return JsonResponse({'error': error})
 
-    data = []
-    for product in stock_data:
-        pid = _get_productid_from_specification(product)
-        found = False
-        for application in applications:
-            if pid == application.marketplace_id:
-                found = True
-                break
-        if not found:
-            data.append(product)
+    response = ProductSpecification.list_new(uid, return_dict=True)
+    if response['error'] is not None:
+        return JsonResponse({'error': response['error']})
+    data = response['product_list']
 
-    request.session['stock'] = data
-    request.session.modified = True
+    # the list is kept out of the session, which only references it
+    payloads.put(request.session, 'stock', data)
 
     return JsonResponse(data, safe=False)
 
@@ -131,17 +140,11 @@ def load_owned_applications(request, *args, **kwargs):
         return JsonResponse({'redirect': kwargs['url']+'/experimentstool/'})
     uid = sso.utils.get_uid(request.user)
 
-    stock_data = _get_stock(access_token, uid)
-    if 'error' in stock_data:
-        return JsonResponse(stock_data, safe=False)
-
-    marketplace_ids = []
-    for product in stock_data:
-        marketplace_ids.append(_get_productid_from_specification(product))
-
-    applications = Application.list(marketplace_ids, return_dict=True)
+    error = marketplace.ensure_synced(access_token, uid)
+    if error is not None:
+        return JsonResponse({'error': error})
 
-    return JsonResponse(applications, safe=False)
+    return JsonResponse(Application.list_by_party(uid, return_dict=True))
 
 
 @token_required
@@ -151,69 +154,29 @@ def load_applications(request, *args, **kwargs):
         return JsonResponse({'redirect': kwargs['url']+'/experimentstool/'})
     uid = sso.utils.get_uid(request.user)
 
-    stock_data = _get_stock(access_token, uid)
-    if 'error' in stock_data:
-        return JsonResponse(stock_data, safe=False)
-    inventory_data = _get_inventory(access_token, uid)
-    if 'error' in inventory_data:
-        return JsonResponse(inventory_data, safe=False)
-
-    marketplace_ids = []
-    for product in stock_data:
-        marketplace_ids.append(_get_productid_from_specification(product))
-    for offering in inventory_data:
-        marketplace_ids.append(
-            _get_productid_from_offering(offering, access_token))
-
-    applications = Application.list(marketplace_ids, return_dict=True)
-
-    return JsonResponse(applications, safe=False)
-
-
-def _get_stock(access_token, uid):
-    headers = {"Authorization": "bearer " + access_token}
-    url = settings.MARKETPLACE_URL + \
-        "/DSProductCatalog/api/catalogManagement/v2/productSpecification" + \
-        "?lifecycleStatus=Launched" + \
-        "&relatedParty.id=" + uid
-
-    text_data = requests.request("GET", url, headers=headers).text
-    return json.loads(text_data)
-
-
-def _get_inventory(access_token, uid):
-    headers = {"Authorization": "bearer " + access_token}
-    url = settings.MARKETPLACE_URL + \
-        "/DSProductInventory/api/productInventory/v2/product" + \
-        "?status=Active" + \
-        "&relatedParty.id=" + uid
-
-    text_data = requests.request("GET", url, headers=headers).text
-    return json.loads(text_data)
-
-
-def _get_productid_from_specification(data):
-    return data["id"]
-
-
-def _get_productid_from_offering(data, access_token):
-    headers = {"Authorization": "bearer " + access_token}
-    url = settings.MARKETPLACE_URL + \
-        urlparse(data["productOffering"]['href']).path
-
-    text_data = requests.request("GET", url, headers=headers).text
-    json_data = json.loads(text_data)
+    error = marketplace.ensure_synced(access_token, uid)
+    if error is not None:
+        return JsonResponse({'error': error})
 
-    return json_data["productSpecification"]["id"]
+    return JsonResponse(Application.list_by_party(uid,
+                                                  inventory=True,
+                                                  return_dict=True))
 
 
 @login_required
 @permission_required('experimentstool.register_app')
 def upload_application(request):
-    if 'stock' not in request.session:
+    if not payloads.has(request.session, 'stock'):
         return JsonResponse({'error': 'No stock products loaded'})
 
-    products = request.session['stock']
+    products = payloads.get(request.session, 'stock')
+    if products is None:
+        # evicted from the cache, the mirror has it anyway
+        response = ProductSpecification.list_new(
+            sso.utils.get_uid(request.user), return_dict=True)
+        if response['error'] is not None:
+            return JsonResponse({'error': response['error']})
+        products = response['product_list']
     product_id = request.POST.get('product', None)
     if not product_id:
         return JsonResponse({'error': 'No product id provided'})
@@ -231,24 +194,23 @@ def upload_application(request):
     if not product:
         return JsonResponse({'error': 'Product not found'})
 
-    # TODO: check errors, if does not exist, etc.
-    blueprint_package = request.FILES['blueprint_package']
+    blueprint_package = request.FILES.get('blueprint_package', None)
+    if blueprint_package is None:
+        return JsonResponse({'error': 'No blueprint package provided'})
 
-    # save the package temporarily
-    tmp_package_file = tempfile.NamedTemporaryFile(
-        suffix=".tar.gz", delete=False)
-    for chunk in blueprint_package.chunks():
-        tmp_package_file.write(chunk)
-    tmp_package_file.flush()
+    marketplace.invalidate(sso.utils.get_uid(request.user))
 
-    response = JsonResponse(Application.create(tmp_package_file.name,
-                                               mso4sc_id,
-                                               product_id,
-                                               request.user,
-                                               return_dict=True))
-    tmp_package_file.close()
+    # the package is published in background, unless the same one was
+    # already published before
+    digest = packages.store(blueprint_package)
+    response = Job.enqueue(Job.UPLOAD_BLUEPRINT,
+                           {'digest': digest,
+                            'blueprint_id': mso4sc_id,
+                            'marketplace_id': product_id},
+                           request.user,
+                           return_dict=True)
 
-    return response
+    return JsonResponse(response)
 
 
 @login_required
@@ -270,6 +232,7 @@ def remove_application(request):
     if application_id < 0:
         return JsonResponse({'error': 'Bad application id provided'})
 
+    marketplace.invalidate(sso.utils.get_uid(request.user))
     return JsonResponse(Application.remove(application_id,
                                            request.user,
                                            return_dict=True))
@@ -277,42 +240,30 @@ def remove_application(request):
 
 @login_required
 def get_datasets(request):
-    url = settings.DATACATALOGUE_URL + \
-        "/api/3/action/package_list"
-
-    text_data = requests.request("GET", url).text
-    json_data = json.loads(text_data)
-    if not json_data["success"]:
-        return JsonResponse([], safe=False)  # TODO(emepetres) manage errors
+    query = request.GET.get('q', '')
+    page = int(request.GET.get('page', 0))
 
-    request.session['datasets'] = json_data["result"]
-    request.session.modified = True
+    if page < 0:
+        return JsonResponse({'error': 'Bad page provided'})
 
-    return JsonResponse(json_data["result"], safe=False)
+    return JsonResponse(Dataset.search(query,
+                                       page,
+                                       settings.DATASETS_PAGE_SIZE,
+                                       return_dict=True))
 
 
 @login_required
 def get_dataset_info(request):
-    if 'datasets' not in request.session:
-        return JsonResponse({'error': 'No datasets loaded'})
-
-    datasets = request.session['datasets']
-    dataset_index = int(request.POST.get('dataset', -1))
-
-    if dataset_index >= len(datasets) or dataset_index < 0:
-        return JsonResponse({'error': 'Bad dataset index provided'})
-
-    dataset = datasets[dataset_index]
+    dataset_pk = int(request.POST.get('dataset', -1))
 
-    url = settings.DATACATALOGUE_URL + \
-        "/api/rest/dataset/" + dataset
+    if dataset_pk < 0:
+        return JsonResponse({'error': 'Bad dataset provided'})
 
-    text_data = requests.request("GET", url).text
-    if text_data == "Not found":
-        return JsonResponse(None)  # TODO(emepetres) manage errors
+    metadata, error = datasets.get_metadata([dataset_pk])
+    if error is not None:
+        return JsonResponse({'error': error})
 
-    json_data = json.loads(text_data)
-    return JsonResponse(json_data, safe=False)
+    return JsonResponse(metadata[dataset_pk], safe=False)
 
 
 @login_required
@@ -328,75 +279,104 @@ def create_deployment(request):
     if application_id < 0:
         return JsonResponse({'error': 'No application selected'})
 
-    hpc_list, error = HPCInfrastructure.list(request.user)
+    resolver = InputsResolver(request.user)
+    tosca_inputs, error = resolver.resolve(inputs)
+    if error is not None:
+        return JsonResponse(error)
+    LOGGER.info('Deployment ' + deployment_id + ' inputs resolved in ' +
+                str(resolver.timings))
+
+    app, error = Application.get(application_id)
+    if app is None or error is not None:
+        return JsonResponse({'error': error or 'Application does not exist'})
+
+    # the deployment is created in background, the job tells the result
+    return JsonResponse(Job.enqueue(Job.CREATE_DEPLOYMENT,
+                                    {'app_pk': application_id,
+                                     'deployment_id': deployment_id,
+                                     'inputs': tosca_inputs},
+                                    request.user,
+                                    return_dict=True))
+
+
+@login_required
+@permission_required('experimentstool.create_instance')
+def create_sweep(request):
+    deployment_id = request.POST.get('deployment_id', None)
+    application_id = int(request.POST.get('application_id', -1))
+    inputs = json.loads(request.POST.get('deployment_inputs', "{}"))
+    grid = json.loads(request.POST.get('sweep_grid', "{}"))
+    overrides = json.loads(request.POST.get('sweep_overrides', "[]"))
+
+    if not deployment_id:
+        return JsonResponse({'error': 'No instance name provided'})
+    if application_id < 0:
+        return JsonResponse({'error': 'No application selected'})
+
+    combinations = Sweep.expand(grid, overrides)
+    if len(combinations) > settings.SWEEP_MAX_DEPLOYMENTS:
+        return JsonResponse(
+            {'error': 'Too many deployments in the sweep (' +
+             str(len(combinations)) + ', max ' +
+             str(settings.SWEEP_MAX_DEPLOYMENTS) + ')'})
+
+    # one resolver for the whole sweep, so infrastructures and datasets
+    # are only loaded once
+    resolver = InputsResolver(request.user)
+    deployments = []
+    for index, combination in enumerate(combinations):
+        tosca_inputs, error = resolver.resolve(dict(inputs, **combination))
+        if error is not None:
+            return JsonResponse(error)
+        deployments.append({
+            'deployment_id': deployment_id + '_' + str(index),
+            'inputs': tosca_inputs})
+    LOGGER.info('Sweep ' + deployment_id + ' inputs resolved in ' +
+                str(resolver.timings))
+
+    sweep, error = Sweep.create(application_id,
+                                deployment_id,
+                                len(deployments),
+                                request.user)
     if error is not None:
         return JsonResponse({'error': error})
 
-    hpc_pattern = re.compile('^mso4sc_hpc_(.)*$')
-    dataset_pattern = re.compile('^mso4sc_dataset_(.)*$')
-    dataset_resource_pattern = re.compile('^resource_mso4sc_dataset_(.)*$')
-    tosca_inputs = {}
-    for _input, value in inputs.items():
-        if hpc_pattern.match(_input):
-            hpc_pk = value
-            if hpc_pk < 0:
-                # the hpc input has no configuration
-                tosca_inputs[_input] = {}
-                continue
-
-            hpc = None
-            for hpc_item in hpc_list:
-                if hpc_item.id == hpc_pk:
-                    hpc = hpc_item
-                    break
-            if not hpc:
-                return JsonResponse({'error': 'Bad HPC provided. Please ' +
-                                     'refresh and try again'})
-
-            tosca_inputs[_input] = hpc.to_dict()
-        elif dataset_pattern.match(_input):
-            if 'datasets' not in request.session:
-                return JsonResponse({'error': 'No datasets loaded'})
-            datasets = request.session['datasets']
-
-            # get the dataset
-            dataset_index = value
-            if dataset_index >= len(datasets) or dataset_index < 0:
-                # the dataset input has no configuration
-                tosca_inputs[_input] = ""
-                continue
-            dataset = _get_dataset(datasets[dataset_index])
-            if 'error' in dataset:
-                return JsonResponse(dataset)
-
-            # get the resource
-            if "resource_" + _input in inputs:
-                dataset_resource_index = int(inputs["resource_" + _input])
-            else:
-                # the dataset input has no configuration
-                tosca_inputs[_input] = ""
-                continue
-
-            if dataset_resource_index >= dataset["num_resources"] or \
-                    dataset_resource_index < 0:
-                return JsonResponse(
-                    {'error': 'Bad dataset resource provided. Please ' +
-                     'refresh and try again'})
-            dataset_resource = dataset["resources"][dataset_resource_index]
-
-            # finally put the url of the resource
-            tosca_inputs[_input] = dataset_resource["url"]
-        elif dataset_resource_pattern.match(_input):
-            # Resources are managed in the dataset section above
-            pass
-        else:
-            tosca_inputs[_input] = value
-
-    return JsonResponse(AppInstance.create(application_id,
-                                           deployment_id,
-                                           tosca_inputs,
-                                           request.user,
-                                           return_dict=True))
+    # deployments are created in background, the job tells the results
+    response = Job.enqueue(Job.CREATE_SWEEP,
+                           {'sweep_pk': sweep.pk,
+                            'deployments': deployments},
+                           request.user,
+                           return_dict=True)
+    if response['error'] is not None:
+        sweep.delete()
+    else:
+        response['sweep_id'] = sweep.pk
+    return JsonResponse(response)
+
+
+@login_required
+def get_sweep(request):
+    sweep_id = int(request.GET.get('sweep_id', -1))
+
+    if sweep_id < 0:
+        return JsonResponse({'error': 'Bad sweep provided'})
+
+    return JsonResponse(Sweep.get(sweep_id, request.user, return_dict=True))
+
+
+@login_required
+def get_sweeps(request):
+    return JsonResponse(Sweep.list(request.user, return_dict=True))
+
+
+@login_required
+def get_job(request):
+    job_id = int(request.GET.get('job_id', -1))
+
+    if job_id < 0:
+        return JsonResponse({'error': 'Bad job provided'})
+
+    return JsonResponse(Job.get(job_id, request.user, return_dict=True))
 
 
 @login_required
@@ -427,6 +407,30 @@ def execute_deployment(request):
                                  return_dict=True))
 
 
+@login_required
+@permission_required('experimentstool.run_instance')
+def execute_deployments(request):
+    try:
+        deployment_ids = [int(pk) for pk in json.loads(
+            request.POST.get('deployment_ids', '[]'))]
+    except (ValueError, TypeError):
+        return JsonResponse({'error': 'Bad deployments provided'})
+    workflow = request.POST.get('workflow')
+    force = request.POST.get('force', 'false') == 'true'
+
+    if not deployment_ids:
+        return JsonResponse({'error': 'No deployments provided'})
+    if not workflow:
+        return JsonResponse({'error': 'No workflow provided'})
+
+    return JsonResponse(
+        WorkflowExecution.create_batch(deployment_ids,
+                                       workflow,
+                                       request.user,
+                                       force=force,
+                                       return_dict=True))
+
+
 @login_required
 def get_executions(request):
     instance_pk = int(request.GET.get('instance', -1))
@@ -464,6 +468,29 @@ def get_executions_events(request):
     return JsonResponse({'events': events, 'error': error})
 
 
+@login_required
+def stream_executions_events(request):
+    execution_pk = int(request.GET.get('exec_id', -1))
+    offset = 0
+
+    if execution_pk < 0:
+        return streams.event_stream_response(
+            streams.error_events('Bad execution provided'))
+
+    # browsers send the id of the last event received when reconnecting
+    last_event_id = request.META.get('HTTP_LAST_EVENT_ID', '')
+    if last_event_id.isdigit():
+        offset = int(last_event_id) + 1
+
+    events, error = WorkflowExecution.stream_execution_events(execution_pk,
+                                                              offset,
+                                                              request.user)
+    if error is not None:
+        return streams.event_stream_response(streams.error_events(error))
+
+    return streams.event_stream_response(streams.limit_streams(events))
+
+
 @login_required
 @permission_required('experimentstool.destroy_instance')
 def destroy_deployment(request):
@@ -490,26 +517,3 @@ def destroy_deployment(request):
             request.session.pop('uninstall_execution')
         request.session.modified = True
     return JsonResponse(response)
-
-
-def _get_dataset(dataset_name):
-    url = settings.DATACATALOGUE_URL + \
-        "/api/3/action/package_search?q=" + \
-        dataset_name
-
-    text_data = requests.request("GET", url).text
-    json_data = json.loads(text_data)
-    if not json_data["success"]:
-        return {'error': json_data['result']}
-
-    response = json_data["result"]
-    if response["count"] <= 0:
-        return {'error': "No data found"}
-    # elif response["count"] == 1:
-    #    return response["results"][0]
-    else:
-        for dataset in response["results"]:
-            if dataset["name"] == dataset_name:
-                return dataset
-
-    return {'error': "No dataset match"}
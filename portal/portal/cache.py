@@ -0,0 +1,294 @@
+""" Shared cache backend module
+
+uwsgi workers and the background commands are different processes, so the
+default local memory cache is duplicated, and cold, in each of them. This
+backend keeps the cache in a SQLite file in WAL mode, shared by every
+process of the host without running another service, and readers don't
+block the writer.
+
+Entries expire after their timeout, and when the cache grows over
+MAX_ENTRIES entries or MAX_SIZE bytes, the expired ones are removed first,
+then the least recently used ones. Counting the entries scans the table,
+so the size is only checked once every CULL_EVERY writes of a process.
+
+    CACHES = {
+        'default': {
+            'BACKEND': 'portal.cache.SQLiteCache',
+            'LOCATION': '/path/to/cache.sqlite3',
+            'OPTIONS': {'MAX_ENTRIES': 10000,
+                        'MAX_SIZE': 64 * 1024 * 1024,
+                        'CULL_EVERY': 50},
+        }
+    }
+"""
+
+import os
+import time
+import pickle
+import sqlite3
+import itertools
+import threading
+from contextlib import contextmanager
+
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+
+# seconds between two updates of the last access of the same entry, so
+# most reads don't need to write
+ACCESS_RESOLUTION = 1.0
+# seconds a process waits for the lock of the database
+BUSY_TIMEOUT = 5.0
+# idle connections kept open by each process
+MAX_IDLE_CONNECTIONS = 16
+
+
+class SQLiteCache(BaseCache):
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        self._path = location
+        options = params.get('OPTIONS', {})
+        self._max_size = int(options.get('MAX_SIZE', 0))
+        self._cull_every = max(int(options.get('CULL_EVERY', 50)), 1)
+        self._writes = itertools.count(1)
+        self._idle = []
+        self._idle_lock = threading.Lock()
+        self._pid = None
+
+    def _open(self):
+        # lent to a thread at a time, not always the one that opened it
+        connection = sqlite3.connect(self._path,
+                                     timeout=BUSY_TIMEOUT,
+                                     isolation_level=None,
+                                     check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS cache ('
+            'key TEXT PRIMARY KEY, '
+            'value BLOB NOT NULL, '
+            'size INTEGER NOT NULL, '
+            'expires REAL, '
+            'accessed REAL NOT NULL)')
+        connection.execute(
+            'CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)')
+        connection.execute(
+            'CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires)')
+        return connection
+
+    @contextmanager
+    def _connection(self):
+        """ Lends an idle connection opened by this process, so the short
+        lived threads of the executors don't open one each """
+        pid = os.getpid()
+        with self._idle_lock:
+            if self._pid != pid:
+                # the connections of the parent are not used after a fork
+                self._idle = []
+                self._pid = pid
+            connection = self._idle.pop() if self._idle else None
+        if connection is None:
+            connection = self._open()
+
+        try:
+            yield connection
+        finally:
+            with self._idle_lock:
+                if self._pid == pid and \
+                        len(self._idle) < MAX_IDLE_CONNECTIONS:
+                    self._idle.append(connection)
+                    connection = None
+            if connection is not None:
+                connection.close()
+
+    @contextmanager
+    def _transaction(self):
+        with self._connection() as connection:
+            with _Transaction(connection):
+                yield connection
+
+    def _key(self, key, version):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return key
+
+    @staticmethod
+    def _is_expired(expires, now):
+        return expires is not None and expires <= now
+
+    def _read(self, connection, keys, now):
+        """ Returns the values of the keys found, and marks them as used """
+        values = {}
+        used = []
+        for index in range(0, len(keys), 500):
+            chunk = keys[index:index + 500]
+            rows = connection.execute(
+                'SELECT key, value, expires, accessed FROM cache '
+                'WHERE key IN (' + ','.join('?' * len(chunk)) + ')',
+                chunk)
+            for key, value, expires, accessed in rows:
+                if self._is_expired(expires, now):
+                    continue
+                values[key] = pickle.loads(value)
+                if now - accessed > ACCESS_RESOLUTION:
+                    used.append((now, key))
+        if used:
+            try:
+                connection.executemany(
+                    'UPDATE cache SET accessed = ? WHERE key = ?', used)
+            except sqlite3.OperationalError:
+                # a busy database only costs some LRU precision
+                pass
+        return values
+
+    def _write(self, connection, key, value, timeout, now):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        connection.execute(
+            'INSERT OR REPLACE INTO cache '
+            '(key, value, size, expires, accessed) VALUES (?, ?, ?, ?, ?)',
+            (key, data, len(data), self.get_backend_timeout(timeout), now))
+
+    def _cull(self, connection, now):
+        if next(self._writes) % self._cull_every != 0:
+            return
+
+        count, size = connection.execute(
+            'SELECT COUNT(*), TOTAL(size) FROM cache').fetchone()
+        if count <= self._max_entries and \
+                (not self._max_size or size <= self._max_size):
+            return
+
+        connection.execute('DELETE FROM cache WHERE expires <= ?', (now,))
+        while True:
+            count, size = connection.execute(
+                'SELECT COUNT(*), TOTAL(size) FROM cache').fetchone()
+            if count == 0 or (count <= self._max_entries and
+                              (not self._max_size or
+                               size <= self._max_size)):
+                return
+            if self._cull_frequency == 0:
+                connection.execute('DELETE FROM cache')
+                return
+            connection.execute(
+                'DELETE FROM cache WHERE key IN ('
+                'SELECT key FROM cache ORDER BY accessed LIMIT ?)',
+                (max(count // self._cull_frequency, 1),))
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self._key(key, version)
+        now = time.time()
+        with self._transaction() as connection:
+            row = connection.execute(
+                'SELECT expires FROM cache WHERE key = ?', (key,)).fetchone()
+            if row is not None and not self._is_expired(row[0], now):
+                return False
+            self._write(connection, key, value, timeout, now)
+            self._cull(connection, now)
+        return True
+
+    def get(self, key, default=None, version=None):
+        key = self._key(key, version)
+        with self._connection() as connection:
+            values = self._read(connection, [key], time.time())
+        return values.get(key, default)
+
+    def get_many(self, keys, version=None):
+        keys = {self._key(key, version): key for key in keys}
+        if not keys:
+            return {}
+        with self._connection() as connection:
+            values = self._read(connection, list(keys), time.time())
+        return {keys[key]: value for key, value in values.items()}
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self._key(key, version)
+        now = time.time()
+        with self._transaction() as connection:
+            self._write(connection, key, value, timeout, now)
+            self._cull(connection, now)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        now = time.time()
+        with self._transaction() as connection:
+            for key, value in data.items():
+                self._write(connection,
+                            self._key(key, version),
+                            value,
+                            timeout,
+                            now)
+            self._cull(connection, now)
+        return []
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self._key(key, version)
+        now = time.time()
+        with self._transaction() as connection:
+            cursor = connection.execute(
+                'UPDATE cache SET expires = ?, accessed = ? '
+                'WHERE key = ? AND (expires IS NULL OR expires > ?)',
+                (self.get_backend_timeout(timeout), now, key, now))
+            return cursor.rowcount > 0
+
+    def incr(self, key, delta=1, version=None):
+        key = self._key(key, version)
+        now = time.time()
+        with self._transaction() as connection:
+            row = connection.execute(
+                'SELECT value, expires FROM cache WHERE key = ?',
+                (key,)).fetchone()
+            if row is None or self._is_expired(row[1], now):
+                raise ValueError("Key '%s' not found" % key)
+            value = pickle.loads(row[0]) + delta
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            connection.execute(
+                'UPDATE cache SET value = ?, size = ?, accessed = ? '
+                'WHERE key = ?',
+                (data, len(data), now, key))
+        return value
+
+    def has_key(self, key, version=None):
+        key = self._key(key, version)
+        with self._connection() as connection:
+            row = connection.execute(
+                'SELECT expires FROM cache WHERE key = ?', (key,)).fetchone()
+        return row is not None and not self._is_expired(row[0], time.time())
+
+    def delete(self, key, version=None):
+        key = self._key(key, version)
+        with self._connection() as connection:
+            connection.execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def delete_many(self, keys, version=None):
+        keys = [self._key(key, version) for key in keys]
+        with self._transaction() as connection:
+            connection.executemany('DELETE FROM cache WHERE key = ?',
+                                   [(key,) for key in keys])
+
+    def clear(self):
+        with self._connection() as connection:
+            connection.execute('DELETE FROM cache')
+
+    def stats(self):
+        """ Returns the number of entries and their size in bytes """
+        with self._connection() as connection:
+            count, size = connection.execute(
+                'SELECT COUNT(*), TOTAL(size) FROM cache').fetchone()
+        return {'entries': count, 'size': int(size)}
+
+
+class _Transaction(object):
+    """ Writes to the cache atomically, taking the database lock at once
+    so two processes can't both read before writing """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute('BEGIN IMMEDIATE')
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.connection.execute('COMMIT')
+        else:
+            self.connection.execute('ROLLBACK')
+        return False
@@ -0,0 +1,286 @@
+""" Outbound HTTP client module
+
+Every call to an external service (Marketplace, CKAN data catalogue...)
+goes through here. Each upstream host has its own keep-alive session, so
+connections are reused between calls, and every request has connect and
+read timeouts plus an overall deadline, so a slow upstream can't hold a
+worker forever. Idempotent GETs are retried a few times on connection
+errors, timeouts and gateway errors, while the deadline allows it.
+
+Identical GETs running at the same time are coalesced: the first one goes
+upstream and the rest wait for its response, within the worker through an
+event and across workers through a lock and the response in the cache.
+"""
+
+import os
+import json
+import time
+import uuid
+import hashlib
+import logging
+import threading
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+# Get an instance of a logger
+LOGGER = logging.getLogger(__name__)
+
+RETRY_STATUS_CODES = (502, 503, 504)
+FLIGHT_CACHE_PREFIX = 'http_flight:'
+
+
+class DeadlineExceeded(requests.exceptions.Timeout):
+    """ The request deadline expired before getting a response """
+    pass
+
+
+class _Upstream(object):
+    """ Session and latency counters of one upstream host """
+
+    def __init__(self, host, pool_size):
+        self.host = host
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.coalesced = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+
+    def record(self, latency, error=False, retry=False):
+        with self._lock:
+            self.requests += 1
+            self.latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            if error:
+                self.errors += 1
+            if retry:
+                self.retries += 1
+
+    def record_coalesced(self):
+        with self._lock:
+            self.coalesced += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'errors': self.errors,
+                'retries': self.retries,
+                'coalesced': self.coalesced,
+                'avg_latency': (self.latency / self.requests
+                                if self.requests else 0.0),
+                'max_latency': self.max_latency,
+            }
+
+
+class _Flight(object):
+    """ A GET in progress, shared by every caller asking the same """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
+_UPSTREAMS = {}
+_UPSTREAMS_PID = None
+_UPSTREAMS_LOCK = threading.Lock()
+
+_FLIGHTS = {}
+_FLIGHTS_LOCK = threading.Lock()
+
+
+def _get_upstream(url):
+    global _UPSTREAMS, _UPSTREAMS_PID
+    parsed_url = urlparse(url)
+    host = parsed_url.scheme + '://' + parsed_url.netloc
+    pid = os.getpid()
+    with _UPSTREAMS_LOCK:
+        # uwsgi forks the workers, sockets can't be shared with the parent
+        if _UPSTREAMS_PID != pid:
+            _UPSTREAMS = {}
+            _UPSTREAMS_PID = pid
+        upstream = _UPSTREAMS.get(host)
+        if upstream is None:
+            upstream = _Upstream(host, settings.HTTP_POOL_SIZE)
+            _UPSTREAMS[host] = upstream
+    return upstream
+
+
+def request(method, url, deadline=None, retries=None, **kwargs):
+    """ Sends a request through the session of the url host
+
+    deadline is the number of seconds the whole call may take, retries
+    included. Only GET requests are retried. Raises a requests exception
+    when no response could be got.
+    """
+    upstream = _get_upstream(url)
+    if deadline is None:
+        deadline = settings.HTTP_DEADLINE
+    if retries is None:
+        retries = settings.HTTP_RETRIES if method.upper() == 'GET' else 0
+    connect_timeout, read_timeout = kwargs.pop(
+        'timeout',
+        (settings.HTTP_CONNECT_TIMEOUT, settings.HTTP_READ_TIMEOUT))
+
+    expires = time.monotonic() + deadline
+    attempt = 0
+    while True:
+        remaining = expires - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded(method + ' ' + url + ' took more than ' +
+                                   str(deadline) + ' seconds')
+
+        start = time.monotonic()
+        error = None
+        response = None
+        try:
+            response = upstream.session.request(
+                method,
+                url,
+                timeout=(min(connect_timeout, remaining),
+                         min(read_timeout, remaining)),
+                **kwargs)
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout) as err:
+            error = err
+        latency = time.monotonic() - start
+
+        failed = error is not None or \
+            response.status_code in RETRY_STATUS_CODES
+        retry = failed and attempt < retries and \
+            expires - time.monotonic() > settings.HTTP_RETRY_BACKOFF
+        upstream.record(latency, error=failed, retry=retry)
+        if not retry:
+            if error is not None:
+                raise error
+            return response
+
+        attempt += 1
+        LOGGER.warning('Retrying ' + method + ' ' + url + ' (' +
+                       str(error or response.status_code) + ')')
+        time.sleep(settings.HTTP_RETRY_BACKOFF * attempt)
+
+
+def _flight_key(url, kwargs):
+    """ Identifies a GET by everything that may change its response """
+    request_data = json.dumps([url,
+                               kwargs.get('params'),
+                               kwargs.get('headers')],
+                              sort_keys=True,
+                              default=str)
+    return hashlib.sha256(request_data.encode('utf-8')).hexdigest()
+
+
+def _to_cache(response):
+    return {'status_code': response.status_code,
+            'headers': dict(response.headers),
+            'content': response.content,
+            'encoding': response.encoding,
+            'url': response.url}
+
+
+def _from_cache(data):
+    response = requests.Response()
+    response.status_code = data['status_code']
+    response.headers.update(data['headers'])
+    response._content = data['content']
+    response.encoding = data['encoding']
+    response.url = data['url']
+    return response
+
+
+def _shared_request(key, url, deadline, kwargs):
+    """ GETs the url, or waits for another worker already getting it """
+    lock_key = FLIGHT_CACHE_PREFIX + key
+    flight_id = uuid.uuid4().hex
+    expires = time.monotonic() + deadline
+    while True:
+        remaining = expires - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded('GET ' + url + ' took more than ' +
+                                   str(deadline) + ' seconds')
+
+        if cache.add(lock_key, flight_id, remaining):
+            try:
+                response = request('GET', url, deadline=remaining, **kwargs)
+                if response.status_code not in RETRY_STATUS_CODES:
+                    cache.set(lock_key + ':' + flight_id,
+                              _to_cache(response),
+                              settings.HTTP_COALESCE_TIMEOUT)
+                return response
+            finally:
+                cache.delete(lock_key)
+
+        # another worker got it first, wait for its response
+        other_id = cache.get(lock_key)
+        while other_id is not None and time.monotonic() < expires:
+            time.sleep(settings.HTTP_COALESCE_POLL)
+            finished = cache.get(lock_key) != other_id
+            data = cache.get(lock_key + ':' + other_id)
+            if data is not None:
+                _get_upstream(url).record_coalesced()
+                return _from_cache(data)
+            if finished:
+                # it failed, try again
+                break
+
+
+def get(url, **kwargs):
+    """ GETs the url, sharing the response with the identical GETs in
+    progress. Callers must not modify the response """
+    if kwargs.get('stream') or not settings.HTTP_COALESCE:
+        return request('GET', url, **kwargs)
+
+    deadline = kwargs.pop('deadline', None) or settings.HTTP_DEADLINE
+    key = _flight_key(url, kwargs)
+    with _FLIGHTS_LOCK:
+        flight = _FLIGHTS.get(key)
+        leader = flight is None
+        if leader:
+            flight = _Flight()
+            _FLIGHTS[key] = flight
+
+    if not leader:
+        if not flight.done.wait(deadline):
+            raise DeadlineExceeded('GET ' + url + ' took more than ' +
+                                   str(deadline) + ' seconds')
+        _get_upstream(url).record_coalesced()
+        if flight.error is not None:
+            raise flight.error
+        return flight.response
+
+    try:
+        flight.response = _shared_request(key, url, deadline, kwargs)
+        return flight.response
+    except Exception as err:
+        flight.error = err
+        raise
+    finally:
+        with _FLIGHTS_LOCK:
+            del _FLIGHTS[key]
+        flight.done.set()
+
+
+def get_json(url, **kwargs):
+    """ GETs the url and decodes the JSON response """
+    return get(url, **kwargs).json()
+
+
+def get_stats():
+    """ Returns the latency counters of each upstream of this worker """
+    with _UPSTREAMS_LOCK:
+        upstreams = list(_UPSTREAMS.values())
+    stats = {upstream.host: upstream.stats() for upstream in upstreams}
+    return {'pid': os.getpid(), 'upstreams': stats}
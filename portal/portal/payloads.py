@@ -0,0 +1,44 @@
+""" Session payloads module
+
+Sessions are stored in the database, and read and written whole on each
+request of the user. Bulky values (i.e. product lists) are kept in the
+shared cache instead, addressed by the hash of their content, and the
+session only holds that hash. Identical payloads of different users are
+stored once, and the cache evicts the ones not used.
+"""
+
+import json
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+
+
+CACHE_PREFIX = 'session_payload:'
+SESSION_PREFIX = '_payload_'
+
+
+def put(session, name, value):
+    """ Stores the value in the cache and its reference in the session """
+    data = json.dumps(value, cls=DjangoJSONEncoder, sort_keys=True)
+    digest = hashlib.sha256(data.encode('utf-8')).hexdigest()
+    cache.set(CACHE_PREFIX + digest, data, settings.SESSION_PAYLOAD_TIMEOUT)
+    if session.get(SESSION_PREFIX + name) != digest:
+        session[SESSION_PREFIX + name] = digest
+
+
+def get(session, name, default=None):
+    """ Returns the value referenced by the session, or default if there is
+    none or it was evicted """
+    digest = session.get(SESSION_PREFIX + name)
+    if digest is None:
+        return default
+    data = cache.get(CACHE_PREFIX + digest)
+    if data is None:
+        return default
+    return json.loads(data)
+
+
+def has(session, name):
+    return SESSION_PREFIX + name in session
@@ -119,6 +119,33 @@ DATABASES = {
 }
 
 
+# Cache, shared by the uwsgi workers and the background commands
+# see portal.cache
+
+CACHES = {
+    'default': {
+        'BACKEND': 'portal.cache.SQLiteCache',
+        'LOCATION': config('CACHE_LOCATION',
+                           default=os.path.join(BASE_DIR, 'cache.sqlite3')),
+        'TIMEOUT': config('CACHE_TIMEOUT', default=300, cast=int),
+        'OPTIONS': {
+            'MAX_ENTRIES': config('CACHE_MAX_ENTRIES',
+                                  default=10000, cast=int),
+            # bytes
+            'MAX_SIZE': config('CACHE_MAX_SIZE',
+                               default=64 * 1024 * 1024, cast=int),
+            # writes of a process between two checks of the limits
+            'CULL_EVERY': config('CACHE_CULL_EVERY', default=50, cast=int),
+        },
+    }
+}
+
+# seconds the bulky values referenced by a session are kept in the cache,
+# see portal.payloads
+SESSION_PAYLOAD_TIMEOUT = config('SESSION_PAYLOAD_TIMEOUT',
+                                 default=3600, cast=int)
+
+
 # Password validation
 # https://docs.djangoproject.com/en/1.11/ref/settings/#auth-password-validators
 
@@ -177,10 +204,102 @@ LOGIN_REDIRECT_URL = 'home'
 MARKETPLACE_URL = config('MARKETPLACE_URL')
 DATACATALOGUE_URL = config('DATACATALOGUE_URL')
 
+# outbound requests to Marketplace and CKAN, see portal.http_client
+HTTP_POOL_SIZE = config('HTTP_POOL_SIZE', default=10, cast=int)
+HTTP_CONNECT_TIMEOUT = config('HTTP_CONNECT_TIMEOUT', default=3.05, cast=float)
+HTTP_READ_TIMEOUT = config('HTTP_READ_TIMEOUT', default=10, cast=float)
+# seconds a whole call may take, retries included
+HTTP_DEADLINE = config('HTTP_DEADLINE', default=20, cast=float)
+HTTP_RETRIES = config('HTTP_RETRIES', default=2, cast=int)
+HTTP_RETRY_BACKOFF = config('HTTP_RETRY_BACKOFF', default=0.2, cast=float)
+# identical GETs at the same time share one upstream call, the response is
+# kept in the cache for the waiting workers, which look for it every poll
+HTTP_COALESCE = config('HTTP_COALESCE', default=True, cast=bool)
+HTTP_COALESCE_TIMEOUT = config('HTTP_COALESCE_TIMEOUT', default=5, cast=int)
+HTTP_COALESCE_POLL = config('HTTP_COALESCE_POLL', default=0.05, cast=float)
+# concurrent Marketplace requests of a single view
+MARKETPLACE_WORKERS = config('MARKETPLACE_WORKERS', default=8, cast=int)
+# seconds the product of a Marketplace offering is known without asking
+OFFERING_CACHE_TIMEOUT = config('OFFERING_CACHE_TIMEOUT',
+                                default=3600, cast=int)
+# seconds the Marketplace mirror of a user is used without refreshing it
+MARKETPLACE_CACHE_TTL = config('MARKETPLACE_CACHE_TTL', default=60, cast=int)
+# seconds between two synchronizations of the whole Marketplace mirror
+MARKETPLACE_SYNC_INTERVAL = config('MARKETPLACE_SYNC_INTERVAL',
+                                   default=300, cast=int)
+# datasets listed at once, and seconds between two synchronizations of the
+# datasets index with the data catalogue
+DATASETS_PAGE_SIZE = config('DATASETS_PAGE_SIZE', default=50, cast=int)
+DATASETS_SYNC_INTERVAL = config('DATASETS_SYNC_INTERVAL',
+                                default=300, cast=int)
+# concurrent data catalogue requests of a single view, and seconds the
+# metadata of a dataset may be cached while its revision does not change
+DATASETS_WORKERS = config('DATASETS_WORKERS', default=4, cast=int)
+DATASETS_METADATA_TIMEOUT = config('DATASETS_METADATA_TIMEOUT',
+                                   default=86400, cast=int)
+
 ORCHESTRATOR_HOST = config('ORCHESTRATOR_HOST')
 ORCHESTRATOR_USER = config('ORCHESTRATOR_USER')
 ORCHESTRATOR_PASS = config('ORCHESTRATOR_PASS')
 ORCHESTRATOR_TENANT = config('ORCHESTRATOR_TENANT')
+# keep-alive connections per worker and seconds before dropping idle ones
+ORCHESTRATOR_POOL_SIZE = config('ORCHESTRATOR_POOL_SIZE',
+                                default=10, cast=int)
+ORCHESTRATOR_POOL_IDLE_TIMEOUT = config('ORCHESTRATOR_POOL_IDLE_TIMEOUT',
+                                        default=60, cast=int)
+# execution log streams a worker serves at once, each holds one of its
+# uwsgi threads (see run-production.sh), the rest of viewers poll
+STREAMS_PER_WORKER = config('STREAMS_PER_WORKER', default=8, cast=int)
+# seconds between two status synchronizations of the running executions
+EXECUTIONS_SYNC_INTERVAL = config('EXECUTIONS_SYNC_INTERVAL',
+                                  default=5, cast=int)
+# concurrent orchestrator calls when executing on several instances
+EXECUTIONS_BATCH_WORKERS = config('EXECUTIONS_BATCH_WORKERS',
+                                  default=10, cast=int)
+
+# background jobs workers, see process_jobs command
+JOBS_WORKERS = config('JOBS_WORKERS', default=4, cast=int)
+JOBS_POLL_INTERVAL = config('JOBS_POLL_INTERVAL', default=1, cast=float)
+# retries wait JOBS_RETRY_DELAY seconds, doubling on each attempt
+JOBS_MAX_ATTEMPTS = config('JOBS_MAX_ATTEMPTS', default=6, cast=int)
+JOBS_RETRY_DELAY = config('JOBS_RETRY_DELAY', default=3, cast=int)
+JOBS_RETRY_MAX_DELAY = config('JOBS_RETRY_MAX_DELAY', default=60, cast=int)
+
+# deployments of a sweep created at the same time, and at most in a sweep
+SWEEP_PARALLELISM = config('SWEEP_PARALLELISM', default=5, cast=int)
+SWEEP_MAX_DEPLOYMENTS = config('SWEEP_MAX_DEPLOYMENTS', default=200, cast=int)
+
+# content-addressed store of the uploaded blueprint packages
+BLUEPRINT_STORE_DIR = config('BLUEPRINT_STORE_DIR',
+                             default=os.path.join(BASE_DIR, 'blueprints'))
+# seconds before a package no application uses is removed from the store
+BLUEPRINT_STORE_MAX_AGE = config('BLUEPRINT_STORE_MAX_AGE',
+                                 default=86400, cast=int)
+
+# ssh connections to each remote desktop host kept by each worker, seconds
+# before closing the idle ones, and seconds between two keepalives
+SSH_POOL_MAX_PER_HOST = config('SSH_POOL_MAX_PER_HOST', default=4, cast=int)
+SSH_POOL_IDLE_TIMEOUT = config('SSH_POOL_IDLE_TIMEOUT',
+                               default=300, cast=int)
+SSH_KEEPALIVE = config('SSH_KEEPALIVE', default=30, cast=int)
+# seconds to connect to a host, and to wait for a free connection to it
+SSH_CONNECT_TIMEOUT = config('SSH_CONNECT_TIMEOUT', default=10, cast=float)
+SSH_POOL_WAIT_TIMEOUT = config('SSH_POOL_WAIT_TIMEOUT',
+                               default=30, cast=float)
+# seconds a remote command may take, and bytes kept of its output
+SSH_COMMAND_DEADLINE = config('SSH_COMMAND_DEADLINE', default=120, cast=float)
+SSH_MAX_OUTPUT = config('SSH_MAX_OUTPUT', default=1024 * 1024, cast=int)
+# remote desktop hosts listed at the same time, and seconds to wait for each
+RD_LIST_WORKERS = config('RD_LIST_WORKERS', default=8, cast=int)
+RD_LIST_TIMEOUT = config('RD_LIST_TIMEOUT', default=10, cast=float)
+# seconds a desktops list is used before refreshing it in background, and
+# seconds before it is not used at all
+RD_LIST_CACHE_TTL = config('RD_LIST_CACHE_TTL', default=30, cast=int)
+RD_LIST_CACHE_MAX_AGE = config('RD_LIST_CACHE_MAX_AGE', default=600, cast=int)
+# idle desktops an infrastructure may keep ahead of time, and seconds
+# between two replenishments of the pools, see maintain_desktops command
+RD_WARM_POOL_MAX = config('RD_WARM_POOL_MAX', default=5, cast=int)
+RD_WARM_POOL_INTERVAL = config('RD_WARM_POOL_INTERVAL', default=10, cast=int)
 
 FIWARE_IDM_ENDPOINT = config('FIWARE_IDM_ENDPOINT')
 SOCIAL_AUTH_FIWARE_KEY = config('SOCIAL_AUTH_FIWARE_KEY')
@@ -0,0 +1,186 @@
+""" Remote desktops module
+
+Lists and creates the desktops of an infrastructure over ssh, and keeps
+its warm pool: desktops created ahead of time by the `maintain_desktops`
+command, so a user asking for a new one gets it at once. Desktops of the
+pool are hidden from the listings until they are handed out.
+"""
+
+import time
+import logging
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+
+from paramiko.ssh_exception import SSHException
+from remotedesktops import ssh
+from remotedesktops.models import WarmDesktop
+
+
+# Get an instance of a logger
+LOGGER = logging.getLogger(__name__)
+
+CREATE_LOCK_PREFIX = 'rd_create:'
+# seconds between two attempts to take the creation lock
+CREATE_LOCK_POLL = 0.5
+
+
+def list_desktops(host, user, password, list_cmd, deadline=None):
+    """ deadline is the number of seconds to get a connection and list """
+    expires = None
+    if deadline is not None:
+        expires = time.monotonic() + deadline
+    try:
+        with ssh.get_connection(host,
+                                user,
+                                password,
+                                timeout=deadline) as client:
+            if expires is not None:
+                deadline = expires - time.monotonic()
+                if deadline <= 0:
+                    raise ssh.CommandTimeout(
+                        'No time left to list the desktops')
+            output, errors, exit_code = client.run(list_cmd,
+                                                   deadline=deadline)
+        if exit_code != 0:
+            return {'error': 'Exit(' + str(exit_code) + '): ' +
+                    (errors or output)}
+
+    except (SSHException, OSError) as ssh_ex:
+        return {'error': str(ssh_ex)}
+
+    output_list = output.split('\n')
+    output_list.pop()  # remove last empty line
+    rd_list = []
+    if len(output_list) > 1:
+        for index in range(1, len(output_list), 2):
+            rd_list.append({'url': output_list[index],
+                            'ro_url': output_list[index + 1][10:]})
+
+    return {'rd_list': rd_list}
+
+
+def create_desktop(host, user, password, create_cmd):
+    try:
+        with ssh.get_connection(host, user, password) as client:
+            output, errors, exit_code = client.run(create_cmd)
+        if exit_code != 0:
+            return {'error': "Couldn't create a new desktop: " + errors}
+    except (SSHException, OSError) as ssh_ex:
+        return {'error': str(ssh_ex)}
+
+    return {}
+
+
+def _get_create_lock_timeout():
+    # a creation, and the listings that find the new desktop
+    return settings.SSH_POOL_WAIT_TIMEOUT + settings.SSH_COMMAND_DEADLINE + \
+        2 * settings.RD_LIST_TIMEOUT + 3 * settings.SSH_CONNECT_TIMEOUT
+
+
+@contextmanager
+def creation_lock(rdi, wait=False):
+    """ Creates the desktops of an infrastructure one at a time, among every
+    process. Yields whether the lock was taken, if wait for as long as
+    the creation holding it may take """
+    lock_key = CREATE_LOCK_PREFIX + str(rdi.pk)
+    expires = time.monotonic() + (_get_create_lock_timeout() if wait else 0)
+    while not cache.add(lock_key, True, _get_create_lock_timeout()):
+        if time.monotonic() >= expires:
+            yield False
+            return
+        time.sleep(CREATE_LOCK_POLL)
+
+    try:
+        yield True
+    finally:
+        cache.delete(lock_key)
+
+
+def hide_warm(result, warm_urls):
+    """ Returns the listing without the idle desktops of the pool """
+    if result.get('error') is not None or not warm_urls:
+        return result
+    result = dict(result)
+    result['rd_list'] = [rd for rd in result['rd_list']
+                         if rd['url'] not in warm_urls]
+    return result
+
+
+def replenish_pool(rdi):
+    """ Creates desktops until the pool of the infrastructure is full,
+    returns the number created and a string error
+
+    A new desktop is told apart listing the desktops before and after
+    creating it. The creations of the owner take the same lock, so if
+    more than one appears none is taken into the pool.
+    """
+    result = list_desktops(rdi.host,
+                           rdi.user,
+                           rdi.password,
+                           rdi.list_cmd,
+                           deadline=settings.RD_LIST_TIMEOUT)
+    if result.get('error') is not None:
+        return (0, result['error'])
+    listed = set(rd['url'] for rd in result['rd_list'])
+
+    # desktops that are gone are not in the pool anymore
+    WarmDesktop.objects.filter(rdi=rdi).exclude(url__in=listed).delete()
+    warm = list(WarmDesktop.objects.filter(rdi=rdi).order_by('created_on'))
+    target = min(rdi.warm_pool_size, settings.RD_WARM_POOL_MAX)
+    if len(warm) > target:
+        # the pool shrank, the newest desktops go to the owner
+        WarmDesktop.objects.filter(
+            pk__in=[desktop.pk for desktop in warm[target:]]).delete()
+        return (0, None)
+
+    created = 0
+    for _ in range(target - len(warm)):
+        with creation_lock(rdi) as locked:
+            if not locked:
+                # the owner is creating one, the pool waits for next time
+                return (created, None)
+            error = _create_warm_desktop(rdi)
+        if error is not None:
+            return (created, error)
+        created += 1
+
+    return (created, None)
+
+
+def _create_warm_desktop(rdi):
+    """ Creates a desktop into the pool, returns a string error """
+    result = list_desktops(rdi.host,
+                           rdi.user,
+                           rdi.password,
+                           rdi.list_cmd,
+                           deadline=settings.RD_LIST_TIMEOUT)
+    if result.get('error') is not None:
+        return result['error']
+    listed = set(rd['url'] for rd in result['rd_list'])
+
+    result = create_desktop(rdi.host,
+                            rdi.user,
+                            rdi.password,
+                            rdi.create_cmd)
+    if result.get('error') is not None:
+        return result['error']
+
+    result = list_desktops(rdi.host,
+                           rdi.user,
+                           rdi.password,
+                           rdi.list_cmd,
+                           deadline=settings.RD_LIST_TIMEOUT)
+    if result.get('error') is not None:
+        return result['error']
+    new_desktops = [rd for rd in result['rd_list']
+                    if rd['url'] not in listed]
+    if len(new_desktops) != 1:
+        return str(len(new_desktops)) + ' new desktops listed after ' + \
+            'creating one'
+
+    WarmDesktop.objects.create(rdi=rdi,
+                               url=new_desktops[0]['url'],
+                               ro_url=new_desktops[0]['ro_url'])
+    return None
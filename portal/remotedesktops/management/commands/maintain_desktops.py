@@ -0,0 +1,70 @@
+""" Keeps the warm pools of remote desktops full """
+
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Q
+
+from remotedesktops import desktops
+from remotedesktops.models import RemoteDesktopInfrastructure
+
+
+# Get an instance of a logger
+LOGGER = logging.getLogger(__name__)
+
+
+def _replenish(rdi):
+    try:
+        created, error = desktops.replenish_pool(rdi)
+        if error is not None:
+            LOGGER.error("Couldn't replenish the pool of " + rdi.name +
+                         ': ' + error)
+        elif created > 0:
+            LOGGER.info(str(created) + ' desktops added to the pool of ' +
+                        rdi.name)
+    except Exception as err:
+        LOGGER.exception(err)
+    finally:
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = 'Creates idle remote desktops ahead of time, up to the warm ' + \
+        'pool size of each infrastructure'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval',
+            type=int,
+            default=settings.RD_WARM_POOL_INTERVAL,
+            help='Seconds between two replenishments')
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Replenish once and exit')
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                # infrastructures with a pool, or with one to release
+                rdi_list = list(RemoteDesktopInfrastructure.objects.filter(
+                    Q(warm_pool_size__gt=0) |
+                    Q(warm_desktops__isnull=False)).distinct())
+                if rdi_list:
+                    # desktops take a while to be created, hosts in parallel
+                    with ThreadPoolExecutor(
+                            max_workers=min(settings.RD_LIST_WORKERS,
+                                            len(rdi_list))) as executor:
+                        list(executor.map(_replenish, rdi_list))
+            except Exception as err:
+                # keep the loop alive, i.e. database locked
+                LOGGER.exception(err)
+                connection.close()
+
+            if options['once']:
+                break
+            time.sleep(options['interval'])
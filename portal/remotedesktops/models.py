@@ -1,7 +1,8 @@
 import logging
 
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
 
 from django.forms.models import model_to_dict
 
@@ -41,6 +42,12 @@ class RemoteDesktopInfrastructure(models.Model):
         default=NOVNC,
     )
 
+    # idle desktops created ahead of time, see WarmDesktop
+    warm_pool_size = models.PositiveSmallIntegerField(default=0)
+    # new desktops served from the pool, and created on request
+    warm_hits = models.PositiveIntegerField(default=0)
+    warm_misses = models.PositiveIntegerField(default=0)
+
     @classmethod
     def get(cls, pk, owner, return_dict=False):
         """ If returning a dict, password is removed """
@@ -97,6 +104,7 @@ class RemoteDesktopInfrastructure(models.Model):
                rdi_type,
                list_cmd,
                create_cmd,
+               warm_pool_size=0,
                return_dict=False):
         error = None
         rdi = None
@@ -108,7 +116,8 @@ class RemoteDesktopInfrastructure(models.Model):
                                      password=password,
                                      rd_tool=rdi_type,
                                      list_cmd=list_cmd,
-                                     create_cmd=create_cmd)
+                                     create_cmd=create_cmd,
+                                     warm_pool_size=warm_pool_size)
         except Exception as err:
             LOGGER.exception(err)
             error = str(err)
@@ -138,9 +147,68 @@ class RemoteDesktopInfrastructure(models.Model):
                 rdi.pop('password')
             return {'rdi': rdi, 'error': error}
 
+    def record_pool_use(self, hit):
+        if hit:
+            type(self).objects.filter(pk=self.pk).update(
+                warm_hits=F('warm_hits') + 1)
+        else:
+            type(self).objects.filter(pk=self.pk).update(
+                warm_misses=F('warm_misses') + 1)
+
+    def get_pool_stats(self):
+        requests_num = self.warm_hits + self.warm_misses
+        return {
+            'rdi': self.pk,
+            'name': self.name,
+            'size': self.warm_pool_size,
+            'idle': self.warm_desktops.count(),
+            'hits': self.warm_hits,
+            'misses': self.warm_misses,
+            'hit_rate': (self.warm_hits / requests_num
+                         if requests_num else 0.0),
+        }
+
     def __str__(self):
         return "{0}: Remote Desktop at {1} from {2}({3})".format(
             self.name,
             self.host,
             self.owner.username,
             self.user)
+
+
+class WarmDesktop(models.Model):
+    """ Idle desktop created ahead of time, not shown to the owner until it
+    is handed out """
+    rdi = models.ForeignKey(
+        RemoteDesktopInfrastructure,
+        on_delete=models.CASCADE,
+        related_name='warm_desktops',
+    )
+    url = models.CharField(max_length=255)
+    ro_url = models.CharField(max_length=255)
+    created_on = models.DateTimeField(auto_now_add=True)
+
+    @classmethod
+    def take(cls, rdi):
+        """ Hands out the oldest idle desktop, or None if there is none """
+        while True:
+            with transaction.atomic():
+                desktop = cls.objects.filter(rdi=rdi) \
+                    .order_by('created_on').first()
+                if desktop is None:
+                    return None
+                # another request may have taken it meanwhile
+                if cls.objects.filter(pk=desktop.pk).delete()[0] > 0:
+                    return {'url': desktop.url, 'ro_url': desktop.ro_url}
+
+    @classmethod
+    def get_urls(cls, rdi_list):
+        """ Returns the set of idle desktop urls of each infrastructure """
+        urls = {rdi.pk: set() for rdi in rdi_list}
+        for rdi_pk, url in cls.objects.filter(rdi__in=rdi_list) \
+                .values_list('rdi_id', 'url'):
+            urls[rdi_pk].add(url)
+        return urls
+
+    def __str__(self):
+        return "Warm desktop {0} of {1}".format(self.url, self.rdi.name)
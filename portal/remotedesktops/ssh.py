@@ -15,19 +15,42 @@
 
 """Wrap of paramiko to send ssh commands
 
+Connections are pooled per worker process by (host, port, user), so
+consecutive commands to the same host reuse the authenticated transport
+instead of connecting and authenticating again. Idle connections are
+kept alive with keepalives and closed after a while.
+
 Todo:
-    * read stderr and return it
     * control SSH exceptions and return failures
 """
+import os
+import time
+import codecs
 import select
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+
 from paramiko import client
+from paramiko.ssh_exception import SSHException
+
+
+# Get an instance of a logger
+LOGGER = logging.getLogger(__name__)
+
+READ_CHUNK_SIZE = 32768
+# seconds between two checks of a command that outputs nothing
+READ_POLL_INTERVAL = 0.1
 
 
 class SshClient(object):
     """Represents a ssh client"""
     _client = None
 
-    def __init__(self, address, username, password, port=22):
+    def __init__(self, address, username, password, port=22, timeout=None):
         # print "Connecting to server ", str(address)+":"+str(port)
         self._client = client.SSHClient()
         self._client.set_missing_host_key_policy(client.AutoAddPolicy())
@@ -36,104 +59,346 @@ class SshClient(object):
             port=port,
             username=username,
             password=password,
-            look_for_keys=False
+            look_for_keys=False,
+            timeout=timeout,
+            banner_timeout=timeout,
+            auth_timeout=timeout
         )
 
     def is_open(self):
         """Check if connection is open"""
         return self._client is not None
 
+    def is_active(self):
+        """Check if the connection is still usable"""
+        if self._client is None:
+            return False
+        transport = self._client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def set_keepalive(self, interval):
+        """Sends a keepalive every interval seconds of inactivity"""
+        if self._client is not None:
+            self._client.get_transport().set_keepalive(interval)
+
     def close_connection(self):
         """Closes opened connection"""
         if self._client is not None:
             self._client.close()
 
-    def send_command(self,
-                     command,
-                     exec_timeout=3000,
-                     read_chunk_timeout=500,
-                     wait_result=False):
-        """Sends a command and returns stdout, stderr and exitcode"""
+    def stream(self, command, deadline=None, max_output=None):
+        """Runs a command and returns its CommandStream
 
-        # Check if connection is made previously
-        if self._client is not None:
-            # there is one channel per command
-            stdin, stdout, stderr = self._client.exec_command(
-                command,
-                timeout=exec_timeout)
-
-            if wait_result:
-                # get the shared channel for stdout/stderr/stdin
-                channel = stdout.channel
-
-                # we do not need stdin
-                stdin.close()
-                # indicate that we're not going to write to that channel
-                channel.shutdown_write()
-
-                # read stdout/stderr in order to prevent read block hangs
-                stdout_chunks = []
-                stdout_chunks.append(stdout.channel.recv(
-                    len(stdout.channel.in_buffer)))
-                # chunked read to prevent stalls
-                while (not channel.closed
-                       or channel.recv_ready()
-                       or channel.recv_stderr_ready()):
-                    # Stop if channel was closed prematurely,
-                    # and there is no data in the buffers.
-                    got_chunk = False
-                    readq, _, _ = select.select([stdout.channel],
-                                                [],
-                                                [],
-                                                read_chunk_timeout)
-                    for c in readq:
-                        if c.recv_ready():
-                            stdout_chunks.append(stdout.channel.recv(
-                                len(c.in_buffer)))
-                            got_chunk = True
-                        if c.recv_stderr_ready():
-                            # make sure to read stderr to prevent stall
-                            stderr.channel.recv_stderr(len(c.in_stderr_buffer))
-                            got_chunk = True
-                    '''
-                    1) make sure that there are at least 2 cycles with no data
-                        in the input buffers in order to not exit too early
-                        (i.e. cat on a >200k file).
-                    2) if no data arrived in the last loop, check if we already
-                        received the exit code
-                    3) check if input buffers are empty
-                    4) exit the loop
-                    '''
-                    if (not got_chunk
-                            and stdout.channel.exit_status_ready()
-                            and not stderr.channel.recv_stderr_ready()
-                            and not stdout.channel.recv_ready()):
-                        # Indicate that we're not going to read from
-                        # this channel anymore
-                        stdout.channel.shutdown_read()
-                        # close the channel
-                        stdout.channel.close()
-                        # Remote side is finished & our bufferes are empty
-                        break
-
-            # close all the pseudofiles
-            stdout.close()
-            stderr.close()
-
-            if wait_result:
-                # exit code is always ready at this point
-                exit_code = stdout.channel.recv_exit_status()
-                if exit_code is 0:
-                    output = b''.join(stdout_chunks).decode(
-                        encoding='UTF-8')
+        deadline is the number of seconds the whole command may take, and
+        max_output the number of bytes kept of each of stdout and stderr.
+        """
+        if self._client is None:
+            raise SSHException('Connection is closed')
+        if deadline is None:
+            deadline = settings.SSH_COMMAND_DEADLINE
+        if max_output is None:
+            max_output = settings.SSH_MAX_OUTPUT
+
+        # there is one channel per command
+        channel = self._client.get_transport().open_session(
+            timeout=deadline)
+        channel.exec_command(command)
+        # we do not need stdin
+        channel.shutdown_write()
+        return CommandStream(channel, command, deadline, max_output)
+
+    def run(self, command, deadline=None, max_output=None):
+        """Runs a command and returns stdout, stderr and exit code"""
+        command_stream = self.stream(command, deadline, max_output)
+        output = command_stream.read()
+        return (output, command_stream.stderr, command_stream.exit_code)
+
+
+class CommandTimeout(SSHException):
+    """The command did not finish before its deadline"""
+    pass
+
+
+class CommandStream(object):
+    """Output of a running command
+
+    Read it whole with read(), or line by line as it arrives with lines().
+    Once the output is exhausted `exit_code` and `stderr` are set. The
+    channel is closed when done, or if the command takes longer than its
+    deadline, raising CommandTimeout. Output over max_output bytes is
+    dropped and `truncated` set.
+    """
+
+    def __init__(self, channel, command, deadline, max_output):
+        self.command = command
+        self.exit_code = None
+        self.stderr = None
+        self.truncated = False
+        self._channel = channel
+        self._deadline = deadline
+        self._expires = time.monotonic() + deadline
+        self._max_output = max_output
+        self._stderr = bytearray()
+
+    def read(self):
+        """Returns the whole stdout, decoded"""
+        output = bytearray()
+        for chunk in self._chunks():
+            self._keep(output, chunk)
+        return output.decode('utf-8', errors='replace')
+
+    def lines(self):
+        """Yields each decoded stdout line, without the line break"""
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        pending = ''
+        for chunk in self._chunks():
+            lines = (pending + decoder.decode(chunk)).split('\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line
+            if len(pending) > self._max_output:
+                # a line can't be longer than the output kept
+                self.truncated = True
+                yield pending
+                pending = ''
+        pending += decoder.decode(b'', final=True)
+        if pending:
+            yield pending
+
+    def _keep(self, buffer, data):
+        room = self._max_output - len(buffer)
+        if len(data) > room:
+            self.truncated = True
+            data = data[:max(room, 0)]
+        buffer.extend(data)
+
+    def _chunks(self):
+        """Yields stdout as it arrives, while stderr is kept aside. Both
+        are read so the command never stalls on a full window"""
+        channel = self._channel
+        try:
+            while True:
+                if time.monotonic() > self._expires:
+                    raise CommandTimeout(
+                        "'" + self.command + "' took more than " +
+                        str(self._deadline) + ' seconds')
+
+                if channel.recv_stderr_ready():
+                    self._keep(self._stderr,
+                               channel.recv_stderr(READ_CHUNK_SIZE))
+                elif channel.recv_ready():
+                    yield channel.recv(READ_CHUNK_SIZE)
+                elif channel.exit_status_ready() and \
+                        (channel.eof_received or channel.closed):
+                    # remote side is finished and the buffers are empty
+                    break
                 else:
-                    output = b''.join(stdout_chunks).decode(
-                        encoding='UTF-8')  # TODO stderr
-                return (output, exit_code)
-            else:
-                return True
-        else:
-            if wait_result:
-                return (None, None)
+                    # stderr alone doesn't wake select, hence the interval
+                    select.select([channel],
+                                  [],
+                                  [],
+                                  max(min(self._expires - time.monotonic(),
+                                          READ_POLL_INTERVAL), 0))
+            self.exit_code = channel.recv_exit_status()
+        finally:
+            self.stderr = self._stderr.decode('utf-8', errors='replace')
+            channel.close()
+
+
+class _PooledClient(object):
+    """A connection of the pool and its credentials"""
+
+    def __init__(self, key, ssh_client, password_digest):
+        self.key = key
+        self.client = ssh_client
+        self.password_digest = password_digest
+        self.last_used = time.monotonic()
+
+
+class SshPool(object):
+    """Process-wide pool of authenticated ssh connections
+
+    Connections are reused by (host, port, user), but there are at most
+    `max_per_host` connections to each host, idle or in use, whatever
+    their port and user. A command waits for one to be free up to
+    `wait_timeout` seconds. Connections idle for more than `idle_timeout`
+    seconds are closed. Hits count commands served by a reused
+    connection, misses count new connections.
+    """
+
+    def __init__(self, max_per_host, idle_timeout, keepalive, wait_timeout):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.wait_timeout = wait_timeout
+        self._lock = threading.Condition()
+        self._idle = {}
+        self._busy = {}
+        self._per_host = {}
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        threading.Thread(target=self._evict_idle_loop,
+                         name='ssh-pool-evictor',
+                         daemon=True).start()
+
+    @contextmanager
+    def connection(self, host, user, password, port=22, timeout=None):
+        """Lends a connection to the host, closing it if the commands
+        sent through it fail. timeout is the number of seconds to wait
+        for it, connecting included"""
+        key = (host, port, user)
+        pooled = self._acquire(key, host, user, password, port, timeout)
+        broken = False
+        try:
+            yield pooled.client
+        except (SSHException, OSError):
+            broken = True
+            raise
+        finally:
+            self._release(key, pooled, broken)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_per_host': self.max_per_host,
+                'idle_timeout': self.idle_timeout,
+                'idle': sum(len(idle) for idle in self._idle.values()),
+                'busy': sum(self._busy.values()),
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+            }
+
+    def _acquire(self, key, host, user, password, port, timeout):
+        password_digest = hashlib.sha256(password.encode('utf-8')).digest()
+        if timeout is None:
+            timeout = self.wait_timeout + settings.SSH_CONNECT_TIMEOUT
+        start = time.monotonic()
+        expires = start + min(timeout, self.wait_timeout)
+        with self._lock:
+            while True:
+                idle = self._idle.setdefault(key, [])
+                for pooled in reversed(idle):
+                    if pooled.password_digest != password_digest:
+                        continue
+                    idle.remove(pooled)
+                    if pooled.client.is_active():
+                        self._busy[key] = self._busy.get(key, 0) + 1
+                        self._hits += 1
+                        return pooled
+                    self._close(pooled)
+                    break
+
+                if self._per_host.get(host, 0) >= self.max_per_host:
+                    # make room closing the least recently used idle one
+                    oldest = self._get_oldest_idle(host)
+                    if oldest is not None:
+                        self._idle[oldest.key].remove(oldest)
+                        self._close(oldest)
+                if self._per_host.get(host, 0) < self.max_per_host:
+                    self._per_host[host] = self._per_host.get(host, 0) + 1
+                    self._busy[key] = self._busy.get(key, 0) + 1
+                    self._misses += 1
+                    break
+
+                remaining = expires - time.monotonic()
+                if remaining <= 0:
+                    raise SSHException('Too many connections to ' + host)
+                self._lock.wait(remaining)
+
+        # the slow handshake doesn't hold the pool
+        try:
+            remaining = start + timeout - time.monotonic()
+            if remaining <= 0:
+                raise SSHException('No time left to connect to ' + host)
+            ssh_client = SshClient(host,
+                                   user,
+                                   password,
+                                   port=port,
+                                   timeout=min(settings.SSH_CONNECT_TIMEOUT,
+                                               remaining))
+            ssh_client.set_keepalive(self.keepalive)
+        except Exception:
+            with self._lock:
+                self._busy[key] -= 1
+                self._per_host[host] -= 1
+                self._lock.notify_all()
+            raise
+        return _PooledClient(key, ssh_client, password_digest)
+
+    def _release(self, key, pooled, broken):
+        with self._lock:
+            self._busy[key] -= 1
+            if broken or not pooled.client.is_active():
+                self._close(pooled)
             else:
-                return False
+                pooled.last_used = time.monotonic()
+                self._idle.setdefault(key, []).append(pooled)
+            self._lock.notify_all()
+
+    def _get_oldest_idle(self, host):
+        oldest = None
+        for key, idle in self._idle.items():
+            if key[0] != host:
+                continue
+            for pooled in idle:
+                if oldest is None or pooled.last_used < oldest.last_used:
+                    oldest = pooled
+        return oldest
+
+    def _close(self, pooled):
+        self._evictions += 1
+        self._per_host[pooled.key[0]] -= 1
+        try:
+            pooled.client.close_connection()
+        except Exception as err:
+            LOGGER.exception(err)
+
+    def _evict_idle_loop(self):
+        while True:
+            time.sleep(self.idle_timeout / 2)
+            now = time.monotonic()
+            with self._lock:
+                for key, idle in self._idle.items():
+                    expired = [pooled for pooled in idle
+                               if now - pooled.last_used > self.idle_timeout]
+                    for pooled in expired:
+                        idle.remove(pooled)
+                        self._close(pooled)
+
+
+_POOL = None
+_POOL_PID = None
+_POOL_LOCK = threading.Lock()
+
+
+def _get_pool():
+    global _POOL, _POOL_PID
+    pid = os.getpid()
+    # uwsgi forks the workers, sockets can't be shared with the parent
+    if _POOL is None or _POOL_PID != pid:
+        with _POOL_LOCK:
+            if _POOL is None or _POOL_PID != pid:
+                _POOL = SshPool(settings.SSH_POOL_MAX_PER_HOST,
+                                settings.SSH_POOL_IDLE_TIMEOUT,
+                                settings.SSH_KEEPALIVE,
+                                settings.SSH_POOL_WAIT_TIMEOUT)
+                _POOL_PID = pid
+    return _POOL
+
+
+def get_connection(host, user, password, port=22, timeout=None):
+    """Lends a pooled connection, to be used in a with statement"""
+    return _get_pool().connection(host,
+                                  user,
+                                  password,
+                                  port=port,
+                                  timeout=timeout)
+
+
+def get_stats():
+    """Returns the hit/miss counters of this worker connection pool"""
+    stats = _get_pool().stats()
+    stats['pid'] = os.getpid()
+    return stats
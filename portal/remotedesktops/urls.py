@@ -12,6 +12,12 @@ urlpatterns = [
         views.delete_rdi, name='_delete_rdi'),
     url(r'^_get_rd_list$',
         views.get_rd_list, name='_get_rd_list'),
+    url(r'^_get_all_rd_list$',
+        views.get_all_rd_list, name='_get_all_rd_list'),
     url(r'^_add_rd$',
         views.add_rd, name='_add_rd'),
+    url(r'^_get_warm_pool_stats$',
+        views.get_warm_pool_stats, name='_get_warm_pool_stats'),
+    url(r'^_get_ssh_stats$',
+        views.get_ssh_stats, name='_get_ssh_stats'),
 ]
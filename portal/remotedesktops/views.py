@@ -1,12 +1,27 @@
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.cache import cache
 from django.core import serializers
 from django.shortcuts import render
 from django.http import JsonResponse
 from django.forms.models import model_to_dict
 
-from paramiko.ssh_exception import SSHException
+from remotedesktops import desktops
 from remotedesktops import ssh
-from remotedesktops.models import RemoteDesktopInfrastructure
+from remotedesktops.models import RemoteDesktopInfrastructure, WarmDesktop
+
+
+# Get an instance of a logger
+LOGGER = logging.getLogger(__name__)
+
+RD_LIST_CACHE_PREFIX = 'rd_list:'
+RD_LIST_VERSION_PREFIX = 'rd_list_version:'
 
 
 @login_required
@@ -14,6 +29,11 @@ def remotedesktops(request):
     return render(request, 'remotedesktops.html', {})
 
 
+@staff_member_required
+def get_ssh_stats(request):
+    return JsonResponse(ssh.get_stats())
+
+
 @login_required
 def get_rdi_list(request):
     return JsonResponse(
@@ -52,6 +72,11 @@ def add_rdi(request):
     if not create_cmd or create_cmd == '':
         return JsonResponse({'error': 'No create command provided'})
 
+    warm_pool_size = int(request.POST.get('warm_pool_size') or 0)
+    if warm_pool_size < 0 or warm_pool_size > settings.RD_WARM_POOL_MAX:
+        return JsonResponse({'error': 'Warm pool size must be between 0 ' +
+                             'and ' + str(settings.RD_WARM_POOL_MAX)})
+
     return JsonResponse(
         RemoteDesktopInfrastructure.create(
             name,
@@ -62,6 +87,7 @@ def add_rdi(request):
             RemoteDesktopInfrastructure.NOVNC,
             list_cmd,
             create_cmd,
+            warm_pool_size=warm_pool_size,
             return_dict=True)
     )
 
@@ -74,79 +100,246 @@ def delete_rdi(request):
         return JsonResponse({'error':
                              'No remote desktop infrastructure provided'})
 
-    return JsonResponse(
-        RemoteDesktopInfrastructure.remove(
-            pk,
-            request.user,
-            return_dict=True))
+    response = RemoteDesktopInfrastructure.remove(pk,
+                                                  request.user,
+                                                  return_dict=True)
+    if response['error'] is None:
+        _invalidate_rd_list(pk)
+    return JsonResponse(response)
 
 
 @login_required
 def get_rd_list(request):
     rdi_pk = request.POST.get('rdi_pk', -1)
-    rdi = _get_remote_desktop_infrastructure(rdi_pk)
+    rdi = _get_remote_desktop_infrastructure(rdi_pk, request.user)
     if rdi is None:
         return JsonResponse({'error': 'Bad infrastructure provided'})
+    refresh = request.POST.get('refresh', 'false') == 'true'
+
+    result = _get_cached_rd_list(rdi, refresh=refresh)
+    warm_urls = WarmDesktop.get_urls([rdi])[rdi.pk]
+    return JsonResponse(desktops.hide_warm(result, warm_urls), safe=False)
 
-    return JsonResponse(_get_rd_list(rdi.host,
-                                     rdi.user,
-                                     rdi.password,
-                                     rdi.list_cmd),
-                        safe=False)
+
+@login_required
+def get_all_rd_list(request):
+    rdi_list, error = RemoteDesktopInfrastructure.list(request.user)
+    if error is not None:
+        return JsonResponse({'error': error})
+    refresh = request.GET.get('refresh', 'false') == 'true'
+
+    return JsonResponse(_get_all_rd_lists(rdi_list, refresh=refresh))
 
 
 @login_required
 def add_rd(request):
     rdi_pk = request.POST.get('rdi_pk', -1)
-    rdi = _get_remote_desktop_infrastructure(rdi_pk)
+    rdi = _get_remote_desktop_infrastructure(rdi_pk, request.user)
     if rdi is None:
         return JsonResponse({'error': 'Bad infrastructure provided'})
 
-    return JsonResponse(_add_rd(rdi.host,
-                                rdi.user,
-                                rdi.password,
-                                rdi.create_cmd),
-                        safe=False)
+    desktop = WarmDesktop.take(rdi)
+    rdi.record_pool_use(hit=desktop is not None)
+    if desktop is not None:
+        response = {'rd': desktop}
+    else:
+        # the pool must not take this desktop for the one it creates
+        with desktops.creation_lock(rdi, wait=True) as locked:
+            if locked:
+                response = desktops.create_desktop(rdi.host,
+                                                   rdi.user,
+                                                   rdi.password,
+                                                   rdi.create_cmd)
+            else:
+                response = {'error': 'Another desktop is being created, ' +
+                            'try again later'}
+
+    # the new desktop must be listed next time
+    _invalidate_rd_list(rdi.pk)
+    return JsonResponse(response, safe=False)
+
+
+@login_required
+def get_warm_pool_stats(request):
+    rdi_list, error = RemoteDesktopInfrastructure.list(request.user)
+    if error is not None:
+        return JsonResponse({'error': error})
+
+    return JsonResponse({'pool_list': [rdi.get_pool_stats()
+                                       for rdi in rdi_list],
+                         'error': None})
 
 
-def _get_remote_desktop_infrastructure(pk):
+def _get_remote_desktop_infrastructure(pk, owner):
     try:
-        rdi = RemoteDesktopInfrastructure.objects.get(pk=pk)
-    except RemoteDesktopInfrastructure.DoesNotExist:
+        rdi = RemoteDesktopInfrastructure.objects.get(pk=pk, owner=owner)
+    except (RemoteDesktopInfrastructure.DoesNotExist, ValueError):
         rdi = None
     return rdi
 
 
-def _get_rd_list(host, user, password, list_cmd):
+def _get_rd_list_version(rdi_pk):
+    return cache.get(RD_LIST_VERSION_PREFIX + str(rdi_pk), 0)
+
+
+def _list_and_cache(rdi, deadline=None):
+    """ Lists the desktops, and caches the list if there was no error
+
+    The list is cached with the version of the infrastructure before
+    listing, so if it is invalidated meanwhile the list is not used.
+    """
+    version = _get_rd_list_version(rdi.pk)
+    result = desktops.list_desktops(rdi.host,
+                                    rdi.user,
+                                    rdi.password,
+                                    rdi.list_cmd,
+                                    deadline=deadline)
+    if result.get('error') is None:
+        cache.set(RD_LIST_CACHE_PREFIX + str(rdi.pk),
+                  {'result': result,
+                   'listed_on': time.time(),
+                   'version': version},
+                  settings.RD_LIST_CACHE_MAX_AGE)
+    return result
+
+
+def _get_refresh_lock_timeout():
+    # the listing is bounded by RD_LIST_TIMEOUT, but the banner and the
+    # authentication steps of the handshake may take their own timeout
+    return settings.RD_LIST_TIMEOUT + 2 * settings.SSH_CONNECT_TIMEOUT
+
+
+def _refresh_in_background(rdi):
+    # only one refresh of the same infrastructure at a time
+    lock_key = RD_LIST_CACHE_PREFIX + 'refresh:' + str(rdi.pk)
+    if not cache.add(lock_key, True, _get_refresh_lock_timeout()):
+        return
+
+    def background_refresh():
+        try:
+            result = _list_and_cache(rdi, deadline=settings.RD_LIST_TIMEOUT)
+            if result.get('error') is not None:
+                LOGGER.error("Couldn't refresh the desktops of " +
+                             rdi.name + ': ' + result['error'])
+        except Exception as err:
+            LOGGER.exception(err)
+        finally:
+            cache.delete(lock_key)
+
+    threading.Thread(target=background_refresh,
+                     name='rd-list-' + str(rdi.pk),
+                     daemon=True).start()
+
+
+def _get_cached_rd_list(rdi, refresh=False, deadline=None):
+    """ Returns the cached desktops of the infrastructure
+
+    Lists older than RD_LIST_CACHE_TTL seconds are returned anyway and
+    refreshed in background. The host is only waited for when forced to
+    refresh, or if there is no list or it is older than
+    RD_LIST_CACHE_MAX_AGE seconds.
+    """
+    entry = None
+    if not refresh:
+        entries = cache.get_many([RD_LIST_CACHE_PREFIX + str(rdi.pk),
+                                  RD_LIST_VERSION_PREFIX + str(rdi.pk)])
+        entry = entries.get(RD_LIST_CACHE_PREFIX + str(rdi.pk))
+        if entry is not None and entry.get('version') != \
+                entries.get(RD_LIST_VERSION_PREFIX + str(rdi.pk), 0):
+            # listed before the last invalidation
+            entry = None
+    if entry is None:
+        return _list_and_cache(rdi, deadline=deadline)
+
+    if time.time() - entry['listed_on'] > settings.RD_LIST_CACHE_TTL:
+        _refresh_in_background(rdi)
+    return entry['result']
+
+
+def _invalidate_rd_list(rdi_pk):
+    version_key = RD_LIST_VERSION_PREFIX + str(rdi_pk)
+    # the version outlives the lists, so a refresh that started before
+    # can't cache an older one
+    cache.add(version_key, 0, None)
     try:
-        client = ssh.SshClient(host, user, password)
-        output, exit_code = client.send_command(list_cmd, wait_result=True)
-        client.close_connection()
-        if exit_code is not 0:
-            return {'error': 'Exit(' + str(exit_code) + '): ' + output}
-
-    except SSHException as ssh_ex:
-        return {'error': str(ssh_ex)}
-
-    output_list = output.split('\n')
-    output_list.pop()  # remove last empty line
-    rd_list = []
-    if len(output_list) > 1:
-        for index in range(1, len(output_list), 2):
-            rd_list.append({'url': output_list[index],
-                            'ro_url': output_list[index + 1][10:]})
-
-    return {'rd_list': rd_list}
+        cache.incr(version_key)
+    except ValueError:
+        # evicted meanwhile
+        cache.set(version_key, 1, None)
+    cache.delete(RD_LIST_CACHE_PREFIX + str(rdi_pk))
 
 
-def _add_rd(host, user, password, create_cmd):
+def _get_timed_rd_list(rdi, refresh=False):
+    start = time.monotonic()
     try:
-        client = ssh.SshClient(host, user, password)
-        output, exit_code = client.send_command(create_cmd, wait_result=True)
-        client.close_connection()
-        if exit_code is not 0:
-            return {'error': "Couldn't create a new desktop"}
-    except SSHException as ssh_ex:
-        return {'error': str(ssh_ex)}
-
-    return {}
+        result = _get_cached_rd_list(rdi,
+                                     refresh=refresh,
+                                     deadline=settings.RD_LIST_TIMEOUT)
+    except Exception as err:
+        LOGGER.exception(err)
+        result = {'error': str(err)}
+    result['latency'] = time.monotonic() - start
+    return result
+
+
+def _get_all_rd_lists(rdi_list, refresh=False):
+    """ Lists the desktops of every infrastructure concurrently
+
+    Infrastructures that don't answer in RD_LIST_TIMEOUT seconds since
+    they started to be listed are reported with an error, the rest are
+    returned anyway.
+    """
+    rdi_list = list(rdi_list)
+    if not rdi_list:
+        return {'rdi_list': [], 'error': None}
+
+    timeout = settings.RD_LIST_TIMEOUT
+    started = {}
+
+    def list_rd(index):
+        started[index] = time.monotonic()
+        return _get_timed_rd_list(rdi_list[index], refresh)
+
+    executor = ThreadPoolExecutor(
+        max_workers=min(settings.RD_LIST_WORKERS, len(rdi_list)))
+    futures = [executor.submit(list_rd, index)
+               for index in range(len(rdi_list))]
+    done = set()
+    late = set()
+    while len(done) + len(late) < len(futures):
+        now = time.monotonic()
+        expires = now + timeout
+        waiting = []
+        for index, future in enumerate(futures):
+            if index in done or index in late:
+                continue
+            if future.done():
+                done.add(index)
+            elif index not in started:
+                # queued, its time does not run yet
+                waiting.append(future)
+            elif now - started[index] >= timeout:
+                late.add(index)
+            else:
+                expires = min(expires, started[index] + timeout)
+                waiting.append(future)
+        if waiting:
+            wait(waiting, timeout=expires - now, return_when=FIRST_COMPLETED)
+    # the late ones end in background, bounded by their own deadline
+    executor.shutdown(wait=False)
+
+    warm_urls = WarmDesktop.get_urls(rdi_list)
+    results = []
+    for index, rdi in enumerate(rdi_list):
+        if index in done:
+            result = desktops.hide_warm(futures[index].result(),
+                                        warm_urls[rdi.pk])
+        else:
+            result = {'error': 'No answer in ' +
+                      str(settings.RD_LIST_TIMEOUT) + ' seconds',
+                      'latency': settings.RD_LIST_TIMEOUT}
+        result['rdi'] = rdi.pk
+        result['name'] = rdi.name
+        results.append(result)
+
+    return {'rdi_list': results, 'error': None}
@@ -3,4 +3,19 @@ set -e
 
 systemctl restart nginx
 
-uwsgi --socket portal.sock --module portal.wsgi --chmod-socket=664
+# background synchronization of the executions status
+python3 manage.py sync_executions &
+# background synchronization of the Marketplace mirror
+python3 manage.py sync_marketplace &
+# background synchronization of the datasets index
+python3 manage.py sync_datasets &
+# background creation of the warm remote desktops
+python3 manage.py maintain_desktops &
+# background orchestrator operations
+python3 manage.py process_jobs &
+
+# log streams hold a thread (not a whole worker) while users watch them,
+# at most STREAMS_PER_WORKER (8) per process, so half of the threads are
+# always left for the rest of requests
+uwsgi --socket portal.sock --module portal.wsgi --chmod-socket=664 \
+    --enable-threads --processes 4 --threads 16